@@ -1,10 +1,27 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import copy
+import errno
 import gettext
+import hashlib
+import ipaddress
+import heapq
 import os
 import platform
+import queue
 import re
+import resource
 import socket
-from contextlib import suppress
+import sqlite3
+import struct
+import subprocess
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext, suppress
+from functools import partial
 
 import segno
 import ufw.common as ufwc
@@ -15,7 +32,7 @@ from deltabot import DeltaBot
 from deltabot.hookspec import deltabot_hookimpl
 from deltachat import Chat, Contact, Message
 
-version = "0.8"
+version = "0.9.0"
 
 
 # >>> HOOKS
@@ -26,7 +43,17 @@ def deltabot_init(bot):
     global dbot
     dbot = bot
     bot.commands.unregister(name="/set")
-    menu()
+    for c in sorted(set().union(*routes.values())):
+        with suppress(Exception):
+            bot.commands.unregister(name=c)
+        bot.commands.register(name=c, func=route)
+    threading.Thread(target=fw_worker, name="fwbot-writer", daemon=True).start()
+    expiry.start()
+    autoban.load()
+    logwatch.start()
+    watch.load()
+    watch.start()
+    audit.start()
 
 
 @deltabot_hookimpl
@@ -43,7 +70,7 @@ def deltabot_start(bot: DeltaBot, chat=Chat):
     else:
         dbot.logger.warn("Creating a firewall-bot group")
         chat = dbot.account.create_group_chat(
-            f"Admin group on {host}", contacts=[], verified=True
+            f"Admin group on {facts.hostname}", contacts=[], verified=True
         )
         dbot.set("admgrpid", chat.id)
         dbot.set("issetup", "yes!")
@@ -56,15 +83,24 @@ def deltabot_start(bot: DeltaBot, chat=Chat):
 
 
 # >>> UTILITIES
-alert = []
 hlp = {
     "info": "Shows system info.",
     "status": "Get and set firewall status.",
     "policy": "Get and set default policies.",
     "rules": "Get and set firewall rules.",
+    "optimize": "Merge rules that only differ by port or network.",
+    "lint": "Find shadowed, redundant and conflicting rules.",
+    "test": "Show which rule decides a packet.",
+    "hot": "Show rule hit counters and move hot rules up.",
+    "block": "Manage blocklists of addresses and networks.",
+    "blocked": "Show what the firewall blocked lately.",
+    "autoban": "Ban sources that are blocked or fail to log in too often.",
     "guide": "Build rules step-by-step.",
     "service": "Show listening services.",
-    "scan": "Perform port-scans. (coming soon)",
+    "scan": "Scan ports and compare them with listeners and rules.",
+    "watch": "Report new listeners and rules changed outside the bot.",
+    "snapshot": "Save and restore the whole firewall setup.",
+    "audit": "Show who changed the firewall and how.",
 }
 
 
@@ -79,20 +115,156 @@ def verify(message):
     return False
 
 
-def menu():
-    for k, v in {"help": ("help", "h", "?"), "eval(c)": hlp.keys()}.items():
-        for c in v:
-            with suppress(Exception):
-                dbot.commands.unregister(name=f"/{c}")
-            dbot.commands.register(name=f"/{c}", func=eval(k))
+class Session:
+    """Screen state, pending alert, guide draft, service IDs and the last
+    /optimize plan of one admin.
 
+    Handlers of the same admin can run on the read pool and the mutation
+    worker at once, lock is held while one of them runs there.
+    """
+
+    __slots__ = ("state", "alert", "gmc", "serv", "dels", "plan", "seen", "lock")
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.state = "menu"
+        self.alert = []
+        self.gmc = []
+        self.serv = []
+        self.dels = []
+        self.plan = None
+        self.seen = 0.0
+
+
+# per (chat, sender), least recently used first
+sessions = OrderedDict()
+slock = threading.Lock()
+smax = 32
+sidle = 3600.0
+
+
+def session(command):
+    key = (command.message.chat.id, command.message.get_sender_contact().addr)
+    now = time.monotonic()
+    with slock:
+        ses = sessions.pop(key, None)
+        if ses is None or now - ses.seen > sidle:
+            ses = Session()
+        while sessions and (
+            len(sessions) >= smax or now - next(iter(sessions.values())).seen > sidle
+        ):
+            sessions.popitem(last=False)
+        ses.seen = now
+        sessions[key] = ses
+        return ses
+
+
+# every command is registered once, route() looks up the handler for the
+# state of the sender's session in the table at the end of this file
+def route(command, replies):
+    """."""
+    if not verify(command.message):
+        return
+    ses = session(command)
+    x = routes[ses.state].get(command.cmd_def.cmd)
+    if x is None or (x[1] is not None and not x[1](ses)):
+        replies.add("⚠️ command not available")
+        return
+    if x[0] in writes:
+        replies.add(f"⏳ queued ({wq.qsize()} ahead)")
+        wq.put(partial(later, x[0], command))
+    elif x[0] in reads:
+        # the screen is switched here, a command for it may follow right away
+        y = screens.get(x[0], "menu")
+        ses.state = y() if callable(y) else y
+        pool.submit(later, x[0], command)
+    else:
+        # screens only, never waits for a queued write of the same admin
+        x[0](command, replies)
+
+
+class Later:
+    """Replies of a handler running outside the hook, sent as they are added."""
+
+    def __init__(self, chat):
+        self.chat = chat
+
+    def add(self, text=None, **kw):
+        self.chat.send_text(text)
 
-def menu_off():
-    for d in [("help", "h", "?"), hlp.keys()]:
-        for c in d:
-            with suppress(Exception):
-                dbot.commands.unregister(name=f"/{c}")
-            dbot.commands.register(name=f"/{c}", func=fake)
+
+# writes are applied one by one in arrival order, reads run next to them
+wq = queue.Queue()
+pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="fwbot-read")
+
+
+def later(func, command):
+    chat = command.message.chat
+    try:
+        with session(command).lock:
+            func(command, Later(chat))
+    except Exception as xcp:
+        dbot.logger.exception(xcp)
+        session(command).state = "menu"
+        chat.send_text(f"📛 ufw error: {xcp}")
+
+
+def fw_worker():
+    while True:
+        job = wq.get()
+        try:
+            # the session before fwlock, in the order read handlers take them
+            ses = nullcontext()
+            if isinstance(job, partial) and job.func is later:
+                ses = session(job.args[1]).lock
+            # readers fall back to the last snapshot while this is held
+            with ses, fwlock:
+                x = audit.before()
+                try:
+                    job()
+                finally:
+                    watch.settle()
+                    audit.after(job, x)
+        except Exception as xcp:
+            dbot.logger.exception(xcp)
+        finally:
+            wq.task_done()
+
+
+# sqlite database of the bot next to the deltachat account
+dbx = {"conn": None}
+dblock = threading.RLock()
+dbschema = (
+    "CREATE TABLE IF NOT EXISTS expiry (id INTEGER PRIMARY KEY, due REAL NOT NULL, cmd TEXT NOT NULL UNIQUE)",
+    "CREATE INDEX IF NOT EXISTS expiry_due ON expiry (due)",
+    "CREATE TABLE IF NOT EXISTS chunk (hash BLOB PRIMARY KEY, data BLOB NOT NULL) WITHOUT ROWID",
+    "CREATE TABLE IF NOT EXISTS snapshot (name TEXT PRIMARY KEY, at REAL NOT NULL, files TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS audit (id INTEGER PRIMARY KEY, ts REAL NOT NULL, actor TEXT NOT NULL, chat INTEGER NOT NULL, cmd TEXT NOT NULL, diff TEXT NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS audit_ts ON audit (ts)",
+    "CREATE INDEX IF NOT EXISTS audit_actor ON audit (actor, ts)",
+    "CREATE TABLE IF NOT EXISTS audit_rule (rule TEXT NOT NULL, id INTEGER NOT NULL, PRIMARY KEY (rule, id)) WITHOUT ROWID",
+    "CREATE INDEX IF NOT EXISTS audit_rule_id ON audit_rule (id, rule)",
+    "CREATE TRIGGER IF NOT EXISTS audit_update BEFORE UPDATE ON audit BEGIN SELECT RAISE(ABORT, 'audit is append-only'); END",
+    "CREATE TRIGGER IF NOT EXISTS audit_delete BEFORE DELETE ON audit BEGIN SELECT RAISE(ABORT, 'audit is append-only'); END",
+    "CREATE TRIGGER IF NOT EXISTS audit_rule_update BEFORE UPDATE ON audit_rule BEGIN SELECT RAISE(ABORT, 'audit is append-only'); END",
+    "CREATE TRIGGER IF NOT EXISTS audit_rule_delete BEFORE DELETE ON audit_rule BEGIN SELECT RAISE(ABORT, 'audit is append-only'); END",
+)
+
+
+def store():
+    with dblock:
+        if dbx["conn"] is None:
+            path = os.path.join(os.path.dirname(dbot.account.db_path), "fwbot.db")
+            c = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            c.execute("PRAGMA journal_mode=WAL")
+            for d in dbschema:
+                c.execute(d)
+            dbx["conn"] = c
+        return dbx["conn"]
+
+
+def admins(text):
+    dbot.account.get_chat_by_id(int(dbot.get("admgrpid"))).send_text(text)
 
 
 def fake(command, replies):
@@ -105,16 +277,110 @@ def fake(command, replies):
         replies.add("⚠️ quit guided mode first")
 
 
+# one frontend per process, rebuilt when ufw's files change or after a mutation
+fwx = {"frontend": None, "last": None, "files": (), "stamp": None, "gen": 0, "mut": 0}
+fwlock = threading.RLock()
+
+
+def fw_stamp(files):
+    x = []
+    for c in files:
+        try:
+            s = os.stat(c)
+            x.append((s.st_ino, s.st_mtime_ns, s.st_size))
+        except OSError:
+            x.append(None)
+    return tuple(x)
+
+
 def fw():
-    gettext.install(ufwc.programName)
-    frontend = ufwf.UFWFrontend(dryrun=False)
-    return (frontend, frontend.backend)
+    # while a write holds the lock other threads get the last frontend
+    if not fwlock.acquire(blocking=fwx["last"] is None):
+        return (fwx["last"], fwx["last"].backend)
+    try:
+        frontend = fwx["frontend"]
+        # stamp before loading, a change while loading forces another rebuild
+        stamp = fw_stamp(fwx["files"])
+        if frontend is not None and stamp == fwx["stamp"]:
+            return (frontend, frontend.backend)
+        if not fwx["gen"]:
+            gettext.install(ufwc.programName)
+        frontend = ufwf.UFWFrontend(dryrun=False)
+        files = tuple(sorted(set(frontend.backend.files.values())))
+        if files != fwx["files"]:
+            stamp = fw_stamp(files)
+        fwx.update(frontend=frontend, last=frontend, files=files, stamp=stamp)
+        fwx["gen"] += 1
+        return (frontend, frontend.backend)
+    finally:
+        fwlock.release()
+
+
+# a write changes the frontend in place, readers get a copy of it until the
+# write is done and fw_invalidate() has them load the new state
+def fw_freeze():
+    fe, be = fw()
+    x = copy.copy(be)
+    x.rules, x.rules6, x.defaults = list(be.rules), list(be.rules6), dict(be.defaults)
+    y = copy.copy(fe)
+    y.backend = x
+    fwx["last"] = y
+    return (fe, be)
+
+
+def fw_invalidate():
+    with fwlock:
+        fwx["frontend"] = None
+        fwx["stamp"] = None
+        fwx["mut"] += 1
+
+
+class RuleRec:
+    __slots__ = ("num", "rule", "cmd")
+
+    def __init__(self, num, rule):
+        self.num = num
+        self.rule = rule
+        self.cmd = ufwp.UFWCommandRule.get_command(rule)
+
+
+class Ruleset:
+    """Numbered rules as shown by /rules, replaced as a whole on changes."""
+
+    __slots__ = ("version", "recs", "listing")
+
+    def __init__(self, version, rules):
+        self.version = version
+        self.recs = tuple(RuleRec(i, r) for i, r in enumerate(rules, 1))
+        self.listing = "\n".join([f"🔹 {c.num}:  '{c.cmd}'" for c in self.recs])
+
+
+# keyed by the user rules files and bumped by every mutation of the bot
+rsx = {"key": None, "set": Ruleset(0, [])}
+
+
+def ruleset():
+    # the published snapshot is served while a write is in progress
+    if not fwlock.acquire(blocking=rsx["key"] is None):
+        return rsx["set"]
+    try:
+        b = fw()[1]
+        key = (fwx["mut"], fw_stamp((b.files["rules"], b.files["rules6"])))
+        if key != rsx["key"]:
+            rsx["set"] = Ruleset(rsx["set"].version + 1, b.get_rules())
+            rsx["key"] = key
+        return rsx["set"]
+    finally:
+        fwlock.release()
 
 
-def clear_cmd():
-    for c in ("/", "start", "stop", "reset", "move", "del"):
-        with suppress(Exception):
-            dbot.commands.unregister(name=f"/{c}")
+def fw_do(pr):
+    try:
+        return fw_freeze()[0].do_action(
+            pr.action, pr.data.get("rule", ""), pr.data.get("iptype", ""), True
+        )
+    finally:
+        fw_invalidate()
 
 
 def help(command, replies):
@@ -129,294 +395,2655 @@ def help(command, replies):
     replies.add(f"🌐 MENU\n\n{x}")
 
 
+# >>> TRANSACTIONS
+
+
+def fw_restore(exe, payload):
+    p = subprocess.run(
+        [exe, "-n"], input=payload, capture_output=True, text=True, check=False
+    )
+    return (p.returncode, p.stdout + p.stderr)
+
+
+# iptables-restore -n flushes and refills every chain declared in the user
+# rules files in one commit, so the user chains are replaced atomically
+def fw_load(b):
+    if not b.is_enabled():
+        return
+    x = [("rules", b.iptables_restore)]
+    if b.use_ipv6():
+        x.append(("rules6", b.ip6tables_restore))
+    for c, exe in x:
+        with open(b.files[c]) as f:
+            rc, out = fw_restore(exe, f.read())
+        if rc != 0:
+            raise ufwc.UFWError(f"problem running {os.path.basename(exe)}: {out}")
+
+
+class Txn:
+    """Edits the user rules in memory, commit writes and reloads them once."""
+
+    def __init__(self):
+        self.done = False
+
+    def __enter__(self):
+        fwlock.acquire()
+        try:
+            self.fe, self.be = fw_freeze()
+            self.old = (list(self.be.rules), list(self.be.rules6))
+            self.raw = {}
+            for c in ("rules", "rules6"):
+                with open(self.be.files[c], "rb") as f:
+                    self.raw[c] = f.read()
+        except BaseException:
+            fwlock.release()
+            raise
+        return self
+
+    def __exit__(self, typ, val, tb):
+        try:
+            if not self.done:
+                self.be.rules[:], self.be.rules6[:] = self.old
+        finally:
+            fw_invalidate()
+            fwlock.release()
+
+    def clear(self):
+        del self.be.rules[:]
+        del self.be.rules6[:]
+
+    # the rules keep their order and end up at position pos and following
+    def move(self, nums, pos):
+        x = self.numbered()
+        pick = [x[c - 1] for c in nums]
+        x = [r for i, r in enumerate(x, 1) if i not in nums]
+        x[pos - 1 : pos - 1] = pick
+        self.assign(x)
+
+    # replaces all rules, numbered like /rules
+    def assign(self, x):
+        if any([a.v6 and not b.v6 for a, b in zip(x, x[1:])]):
+            raise ufwc.UFWError("ipv4 and ipv6 rules can't be mixed")
+        self.be.rules[:] = [r for r in x if not r.v6]
+        self.be.rules6[:] = [r for r in x if r.v6]
+
+    def numbered(self):
+        return self.be.rules + self.be.rules6
+
+    def lst(self, v6):
+        if v6:
+            return self.be.rules6
+        return self.be.rules
+
+    # missing_ok skips deleting a rule that isn't there for an ip version
+    def apply(self, pr, missing_ok=False):
+        rule = pr.data.get("rule", "")
+        if pr.action == "delete":
+            x = self.numbered()
+            if not str(rule).isnumeric() or not 0 < int(rule) <= len(x):
+                raise ufwc.UFWError(f"Could not find rule '{rule}'")
+            r = x[int(rule) - 1]
+            self.lst(r.v6).remove(r)
+            return
+        if rule.dapp or rule.sapp:
+            raise ufwc.UFWError("application rules are not supported here")
+        iptype = pr.data.get("iptype", "")
+        x = []
+        # the v6 twin of a 'both' rule is placed first, numbering still intact
+        if iptype == "v6" or (iptype == "both" and self.be.use_ipv6()):
+            r = rule.dup_rule()
+            r.set_v6(True)
+            x.append(self.put(r, iptype == "both", missing_ok))
+        if iptype in ("v4", "both"):
+            r = rule.dup_rule()
+            r.set_v6(False)
+            x.append(self.put(r, missing_ok=missing_ok))
+        # True if the rule is new for every ip version
+        return all(x)
+
+    # same semantics as the backend: skip duplicates, update changed actions,
+    # True if the rule was added
+    def put(self, rule, twin=False, missing_ok=False):
+        # matched in the form the rules are stored in, like set_rule() does
+        rule.normalize()
+        x = self.lst(rule.v6)
+        pos = rule.position
+        for i, r in enumerate(x):
+            m = r.match(rule)
+            if m == 0:
+                if rule.remove:
+                    del x[i]
+                return False
+            if m < 0 and not rule.remove and not pos:
+                x[i] = rule
+                return False
+        if rule.remove:
+            if missing_ok:
+                return False
+            raise ufwc.UFWError("Could not delete non-existent rule")
+        if not pos:
+            x.append(rule)
+            return True
+        # positions are numbered like /rules, v6 rules follow the v4 rules
+        n = len(self.be.rules)
+        if not rule.v6:
+            if pos > n + 1:
+                raise ufwc.UFWError(f"Invalid position '{pos}'")
+            x.insert(pos - 1, rule)
+        elif not twin:
+            if pos > n + len(x) + 1:
+                raise ufwc.UFWError(f"Invalid position '{pos}'")
+            x.insert(max(pos - n - 1, 0), rule)
+        else:
+            # in front of the v6 twin of the v4 rule it is inserted before
+            i = len(x)
+            if pos <= n:
+                y = self.be.rules[pos - 1].dup_rule()
+                y.set_v6(True)
+                for j, r in enumerate(x):
+                    if r.match(y) == 0:
+                        i = j
+                        break
+            x.insert(i, rule)
+        return True
+
+    def commit(self):
+        b = self.be
+        try:
+            b._write_rules(False)
+            b._write_rules(True)
+            fw_load(b)
+        except Exception:
+            self.rollback()
+            raise
+        self.done = True
+
+    def rollback(self):
+        for c, d in self.raw.items():
+            with open(self.be.files[c], "wb") as f:
+                f.write(d)
+        with suppress(Exception):
+            fw_load(self.be)
+
+
+# >>> INDEXES
+
+
+# ufw port specs like '22', '80,443' or '1000:2000,8080', None for any
+def port_ranges(spec):
+    if spec in ("", "any", None):
+        return None
+    x = []
+    for c in str(spec).split(","):
+        lo, _, hi = c.partition(":")
+        lo = int(lo)
+        hi = int(hi) if hi else lo
+        if not 0 <= lo <= hi <= 65535:
+            raise ValueError(spec)
+        x.append((lo, hi))
+    return x
+
+
+def rule_net(addr):
+    with suppress(ValueError, TypeError):
+        return ipaddress.ip_network(addr, strict=False)
+    return None
+
+
+class RuleShape:
+    """The parsed match fields of a rule.
+
+    Ports of None match any port, fields that can't be parsed (application
+    rules, odd specs) are None as well but clear exact, so such a rule is
+    never said to cover or to be covered by another one.
+    """
+
+    __slots__ = ("chain", "proto", "iface", "dports", "sports", "src", "dst", "exact")
+
+    def __init__(self, r):
+        self.chain = (r.v6, r.direction, getattr(r, "forward", False))
+        self.proto = r.protocol
+        self.iface = (r.interface_in, r.interface_out)
+        self.exact = not (r.dapp or r.sapp)
+        x = []
+        for c in (r.dport, r.sport):
+            try:
+                x.append(port_ranges(c))
+            except ValueError:
+                x.append(None)
+                self.exact = False
+        self.dports, self.sports = x
+        self.src = rule_net(r.src)
+        self.dst = rule_net(r.dst)
+        if self.src is None or self.dst is None:
+            self.exact = False
+
+    # whether both rules can see the same packet
+    def overlaps(self, o):
+        if self.chain != o.chain:
+            return False
+        if "any" not in (self.proto, o.proto) and self.proto != o.proto:
+            return False
+        for c, d in zip(self.iface, o.iface):
+            if c and d and c != d:
+                return False
+        for x, y in ((self.dports, o.dports), (self.sports, o.sports)):
+            if x and y and not any([p <= s and r <= q for p, q in x for r, s in y]):
+                return False
+        for x, y in ((self.src, o.src), (self.dst, o.dst)):
+            if x is not None and y is not None and not x.overlaps(y):
+                return False
+        return True
+
+    # whether every packet of o is seen by this rule
+    def covers(self, o):
+        if not (self.exact and o.exact) or self.chain != o.chain:
+            return False
+        if self.proto not in ("any", o.proto):
+            return False
+        for c, d in zip(self.iface, o.iface):
+            if c and c != d:
+                return False
+        for x, y in ((self.dports, o.dports), (self.sports, o.sports)):
+            if x is None:
+                continue
+            if y is None or not all([any([p <= r and s <= q for p, q in x]) for r, s in y]):
+                return False
+        return self.src.supernet_of(o.src) and self.dst.supernet_of(o.dst)
+
+
+class PortTree:
+    """Segment tree over the port space, stabbing queries in O(log n + k)."""
+
+    __slots__ = ("nodes",)
+
+    def __init__(self):
+        self.nodes = {}
+
+    # every node on the way is kept, so a missing node has no subtree
+    def add(self, lo, hi, item):
+        x = [(1, 0, 65535)]
+        while x:
+            i, a, b = x.pop()
+            y = self.nodes.setdefault(i, [])
+            if lo <= a and b <= hi:
+                y.append(item)
+                continue
+            m = (a + b) // 2
+            if lo <= m:
+                x.append((2 * i, a, m))
+            if hi > m:
+                x.append((2 * i + 1, m + 1, b))
+
+    def stab(self, port):
+        x = []
+        i, a, b = 1, 0, 65535
+        while True:
+            y = self.nodes.get(i)
+            if y is None:
+                return x
+            x.extend(y)
+            if a == b:
+                return x
+            m = (a + b) // 2
+            if port <= m:
+                i, b = 2 * i, m
+            else:
+                i, a = 2 * i + 1, m + 1
+
+    # items overlapping lo..hi, possibly more than once
+    def span(self, lo, hi):
+        x = []
+        y = [(1, 0, 65535)]
+        while y:
+            i, a, b = y.pop()
+            z = self.nodes.get(i)
+            if z is None:
+                continue
+            x.extend(z)
+            if a == b:
+                continue
+            m = (a + b) // 2
+            if lo <= m:
+                y.append((2 * i, a, m))
+            if hi > m:
+                y.append((2 * i + 1, m + 1, b))
+        return x
+
+
+class CidrTrie:
+    """Binary prefix trie, finds the networks containing an address."""
+
+    __slots__ = ("root",)
+
+    def __init__(self):
+        # node: [child 0, child 1, items]
+        self.root = [None, None, None]
+
+    def add(self, net, item):
+        n = self.root
+        v = int(net.network_address)
+        w = net.max_prefixlen
+        for i in range(net.prefixlen):
+            b = (v >> (w - 1 - i)) & 1
+            if n[b] is None:
+                n[b] = [None, None, None]
+            n = n[b]
+        if n[2] is None:
+            n[2] = []
+        n[2].append(item)
+
+    # lists of items on the path down to net, i.e. all covering prefixes
+    def covering(self, net):
+        x = []
+        n = self.root
+        v = int(net.network_address)
+        w = net.max_prefixlen
+        for i in range(net.prefixlen + 1):
+            if n[2]:
+                x.append(n[2])
+            if i == net.prefixlen:
+                break
+            n = n[(v >> (w - 1 - i)) & 1]
+            if n is None:
+                break
+        return x
+
+    # lists of items at or below net, i.e. all prefixes inside it
+    def inside(self, net):
+        n = self.root
+        v = int(net.network_address)
+        w = net.max_prefixlen
+        for i in range(net.prefixlen):
+            n = n[(v >> (w - 1 - i)) & 1]
+            if n is None:
+                return []
+        x = []
+        y = [n]
+        while y:
+            n = y.pop()
+            if n[2]:
+                x.append(n[2])
+            y.extend([c for c in n[:2] if c is not None])
+        return x
+
+
+class MatchIndex:
+    """Same result as the backend's get_matching() without scanning all rules.
+
+    Rules are bucketed by ip version and protocol, their destination ports go
+    into a PortTree and their destination networks into a CidrTrie. A lookup
+    only confirms the few candidates with ufw's own fuzzy_dst_match().
+    """
+
+    def __init__(self, recs):
+        self.recs = recs
+        self.buckets = {}
+        self.tries = {False: CidrTrie(), True: CidrTrie()}
+        self.loose = {False: set(), True: set()}
+        for c in recs:
+            r = c.rule
+            if r.direction != "in":
+                continue
+            k = (r.v6, r.protocol)
+            if k not in self.buckets:
+                self.buckets[k] = ([], PortTree())
+            try:
+                x = port_ranges(r.dport)
+            except ValueError:
+                x = None
+            if x is None:
+                self.buckets[k][0].append(c.num)
+            else:
+                for lo, hi in x:
+                    self.buckets[k][1].add(lo, hi, c.num)
+            d = rule_net(r.dst)
+            if r.interface_in or d is None:
+                self.loose[r.v6].add(c.num)
+            else:
+                self.tries[r.v6].add(d, c.num)
+
+    def match(self, rule):
+        x = set()
+        port = int(rule.dport)
+        for c in (rule.protocol, "any"):
+            y = self.buckets.get((rule.v6, c))
+            if y:
+                x.update(y[0])
+                x.update(y[1].stab(port))
+        d = rule_net(rule.dst)
+        if x and d is not None and d.prefixlen > 0:
+            y = set(self.loose[rule.v6])
+            for c in self.tries[rule.v6].covering(d):
+                y.update(c)
+            x &= y
+        return [c for c in sorted(x) if rule.fuzzy_dst_match(self.recs[c - 1].rule) < 1]
+
+
 # >>> INFO
 
 
+class HostFacts:
+    """Names, addresses and interfaces of this host.
+
+    Interfaces are re-read when older than ttl. Name lookups run in a
+    background thread, callers get the last known values and only the very
+    first lookup is waited for, at most timeout seconds.
+    """
+
+    def __init__(self, ttl=60.0, dns_ttl=600.0, timeout=2.0):
+        self.ttl = ttl
+        self.dns_ttl = dns_ttl
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.platform = platform.platform()
+        self.hostname = socket.gethostname()
+        self.fqdn = self.hostname
+        self.ip = "unknown"
+        self.ifs = {}
+        self.if_at = None
+        self.dns_at = None
+        self.resolving = False
+
+    def interfaces(self):
+        with self.lock:
+            if self.if_at is None or time.monotonic() - self.if_at > self.ttl:
+                self.ifs = self.read_interfaces()
+                self.if_at = time.monotonic()
+            return self.ifs
+
+    @staticmethod
+    def read_interfaces():
+        x = {}
+        with suppress(OSError):
+            with open("/proc/net/dev") as f:
+                for c in f.read().splitlines()[2:]:
+                    name = c.split(":")[0].strip()
+                    with suppress(Exception):
+                        x[ipaddress.ip_address(ufwu.get_ip_from_if(name, False))] = name
+        with suppress(OSError):
+            with open("/proc/net/if_inet6") as f:
+                for c in f.read().splitlines():
+                    y = c.split()
+                    if len(y) == 6:
+                        x.setdefault(ipaddress.IPv6Address(int(y[0], 16)), y[5])
+        return x
+
+    # same answer as ufw.util.get_if_from_ip(), '' when not found
+    def iface(self, addr):
+        with suppress(ValueError):
+            return self.interfaces().get(ipaddress.ip_address(addr), "")
+        return ""
+
+    def resolve(self):
+        try:
+            fqdn = socket.getfqdn()
+            ip = socket.gethostbyname(fqdn)
+            self.hostname = socket.gethostname()
+            self.fqdn = fqdn
+            self.ip = ip
+        except OSError as xcp:
+            dbot.logger.warn(f"host lookup failed: {xcp}")
+        finally:
+            self.dns_at = time.monotonic()
+            self.resolving = False
+            self.ready.set()
+
+    def names(self):
+        with self.lock:
+            stale = self.dns_at is None or time.monotonic() - self.dns_at > self.dns_ttl
+            if stale and not self.resolving:
+                self.resolving = True
+                threading.Thread(target=self.resolve, daemon=True).start()
+        self.ready.wait(self.timeout)
+        return (self.hostname, self.fqdn, self.ip)
+
+
+facts = HostFacts()
+
+
 def info(command, replies):
     """."""
     if not verify(command.message):
         return
-    host = socket.gethostname()
-    ip = socket.gethostbyname(socket.getfqdn())
-    lin = platform.platform()
+    host, _, ip = facts.names()
+    replies.add(
+        f"🌐 SYSTEM\n🔹 Hostname:  '{host}'\n🔹 IP-address:  '{ip}'\n🔹 fwbot version:  '{version}'\n🔹 OS:  '{facts.platform}'"
+    )
+
+
+# >>> STATUS
+
+
+class Chains:
+    """The filter table of one ip version as reported by iptables-save."""
+
+    __slots__ = ("pre", "names", "policies", "counts", "rejects")
+
+    def __init__(self, pre):
+        self.pre = pre
+        self.names = set()
+        self.policies = {}
+        self.counts = {}
+        self.rejects = set()
+
+    def policy(self, direction):
+        x = self.policies.get(direction.upper())
+        if x == "ACCEPT":
+            return "allow"
+        if f"{self.pre}-reject-{direction}" in self.rejects:
+            return "reject"
+        if x:
+            return "deny"
+        return None
+
+    def user(self):
+        return sum([self.counts.get(f"{self.pre}-user-{c}", 0) for c in ("input", "output", "forward")])
+
+    def present(self):
+        return {f"{self.pre}-user-input", f"{self.pre}-user-output"} <= self.names
+
+
+# a single streaming pass over the saved filter table, ip6tables chains are
+# named ufw6-*
+def fw_save(exe, pre="ufw"):
+    x = Chains(pre)
+    try:
+        p = subprocess.Popen(
+            [exe, "-t", "filter"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+    except OSError:
+        return None
+    with p.stdout:
+        for c in p.stdout:
+            if c.startswith("-A "):
+                y = c.split(None, 2)[1]
+                x.counts[y] = x.counts.get(y, 0) + 1
+                if " -j REJECT" in c:
+                    x.rejects.add(y)
+            elif c.startswith(":"):
+                y = c[1:].split()
+                x.names.add(y[0])
+                if len(y) > 1 and y[1] != "-":
+                    x.policies[y[0]] = y[1]
+    if p.wait() != 0:
+        return None
+    return x
+
+
+class FwState:
+    __slots__ = ("v4", "v6", "active", "incoming", "outgoing")
+
+
+# shared by /status and /policy, refreshed after mutations or a few seconds
+stx = {"key": None, "at": 0.0, "state": None}
+
+
+def fw_state(ttl=3.0):
+    b = fw()[1]
+    key = fwx["mut"]
+    if stx["key"] == key and time.monotonic() - stx["at"] < ttl:
+        return stx["state"]
+    x = FwState()
+    x.v4 = fw_save(f"{b.iptables}-save")
+    x.v6 = None
+    if b.use_ipv6():
+        x.v6 = fw_save(f"{b.ip6tables}-save", "ufw6")
+    x.active = x.v4 is not None and x.v4.present()
+    x.incoming = None
+    x.outgoing = None
+    if x.active:
+        x.incoming = x.v4.policy("input")
+        x.outgoing = x.v4.policy("output")
+    stx.update(key=key, at=time.monotonic(), state=x)
+    return x
+
+
+def status(command, replies):
+    """."""
+    if not verify(command.message):
+        return
+    ses = session(command)
+    st = fw_state()
+    y = []
+    for c, d in (("ipv4", st.v4), ("ipv6", st.v6)):
+        if d is None:
+            e = "not available"
+            if c == "ipv6" and not fw()[1].use_ipv6():
+                e = "disabled"
+        elif d.present():
+            e = f"chains present, {d.user()} user chain rules"
+        else:
+            e = "chains missing"
+        y.append(f"🔹 {c}:  '{e}'")
+    if st.active:
+        y.append(f"🔹 incoming:  '{st.incoming}'\n🔹 outgoing:  '{st.outgoing}'")
+    y = "\n".join(y)
+    if st.active:
+        ses.state = "status_on"
+        replies.add(f"🌐 STATUS\n🔹 firewall:  'active'\n{y}\n\n🔺 /stop\nStopps firewall and disables startup on boot.")
+    else:
+        ses.state = "status_off"
+        replies.add(f"🌐 STATUS\n🔹 firewall:  'inactive'\n{y}\n\n🔺 /start\nStarts firewall and enables startup on boot.")
+
+
+def status_start(command, replies):
+    """."""
+    if not verify(command.message):
+        return
+    ses = session(command)
+    ses.state = "menu"
+    try:
+        fw_freeze()[0].set_enabled(True)
+    finally:
+        fw_invalidate()
+    status(command, replies)
+
+
+def status_stop(command, replies):
+    """."""
+    if not verify(command.message):
+        return
+    ses = session(command)
+    ses.state = "menu"
+    try:
+        fw_freeze()[0].set_enabled(False)
+    finally:
+        fw_invalidate()
+    status(command, replies)
+
+
+# >>> POLICY
+
+
+def policy(command, replies):
+    """."""
+    if not verify(command.message):
+        return
+    ses = session(command)
+    alrt = ""
+    if ses.alert:
+        alrt = f"{ses.alert[0]}\n\n"
+        ses.alert.clear()
+    st = fw_state()
+    x = (st.incoming, st.outgoing)
+    if not st.active:
+        b = fw()[1]
+        x = (b._get_default_policy(), b._get_default_policy("output"))
+    ses.state = "policy"
+    replies.add(
+        f"{alrt}🌐 POLICIES\n🔹 incoming:  '{x[0]}'\n🔹 outgoing:  '{x[1]}'\n\n🔺 //  *action*  *action*\nSet the default action for incoming (1st) and outgoing (2nd) traffic to allow, deny or reject."
+    )
+
+
+def policy_set(command, replies):
+    """."""
+    if not verify(command.message):
+        return
+    ses = session(command)
+    ses.state = "menu"
+    pl = [c for c in command.payload.split() if c.strip()]
+    if len(pl) != 2:
+        ses.alert.append("⚠️ expects two arguments")
+    elif not set(pl).issubset({"reject", "allow", "deny"}):
+        ses.alert.append("⚠️ arguments must be reject, allow or deny")
+    else:
+        b = fw_freeze()[1]
+        try:
+            for c, d in zip(("incoming", "outgoing"), pl):
+                b.set_default_policy(d, c)
+            if b.is_enabled():
+                policy_load(b)
+        finally:
+            fw_invalidate()
+    policy(command, replies)
+
+
+# the declarations and rules of a restore file, None unless it only has *filter
+def policy_filter(path):
+    x = ([], [])
+    with open(path) as f:
+        for c in f:
+            c = c.strip()
+            if not c or c.startswith("#") or c == "COMMIT":
+                continue
+            if c.startswith("*"):
+                if c != "*filter":
+                    return None
+            elif c.startswith(":"):
+                x[0].append(c)
+            else:
+                x[1].append(c)
+    return x
+
+
+# builtin policy, terminal chains of the policy and the chains of the files
+# in one *filter commit, None if the live chains don't look like ufw's
+def policy_payload(b, ch, pre, files, tail=()):
+    if ch is None or not ch.present():
+        return None
+    x = []
+    y = []
+    for c in ("input", "output"):
+        d = b._get_default_policy(c)
+        if d not in ("allow", "deny", "reject"):
+            return None
+        t = {"allow": "ACCEPT", "deny": "DROP", "reject": "REJECT"}[d]
+        x.append(f":{c.upper()} {'ACCEPT' if d == 'allow' else 'DROP'} [0:0]")
+        for e in ("skip-to-policy", "reject", "track"):
+            x.append(f":{pre}-{e}-{c} - [0:0]")
+        y.append(f"-A {pre}-skip-to-policy-{c} -j {t}")
+        if d == "reject":
+            y.append(f"-A {pre}-reject-{c} -j REJECT")
+        if d == "allow":
+            for e in ("tcp", "udp"):
+                y.append(f"-A {pre}-track-{c} -p {e} -m conntrack --ctstate NEW -j ACCEPT")
+    for c in files:
+        z = policy_filter(c)
+        if z is None:
+            return None
+        x += z[0]
+        y += z[1]
+    y += [c for c in tail if c not in y]
+    # declarations first and once per chain, no chain may be created here
+    z = {}
+    for c in x:
+        z.setdefault(c[1:].split()[0], c)
+    if not set(z) - {"INPUT", "OUTPUT", "FORWARD"} <= ch.names:
+        return None
+    return "\n".join(["*filter", *z.values(), *y, "COMMIT", ""])
+
+
+# replaces the policy dependent chains in place instead of stop and start, the
+# filtering chains are swapped in one commit so there is no unfiltered window,
+# with before the before chains are swapped too and the files taken as they are
+def policy_load(b, before=False):
+    if not before:
+        b._write_rules(False)
+        b._write_rules(True)
+    st = fw_state(0)
+    k = [("after_rules", "after6_rules"), ("rules", "rules6")]
+    if before:
+        k.insert(0, ("before_rules", "before6_rules"))
+    x = [(b.iptables_restore, st.v4, "ufw", [c[0] for c in k])]
+    if b.use_ipv6():
+        x.append((b.ip6tables_restore, st.v6, "ufw6", [c[1] for c in k]))
+    y = []
+    for exe, ch, pre, files in x:
+        # ufw-init appends the jumps to the user chains after the before rules
+        t = [f"-A {pre}-before-{c} -j {pre}-user-{c}" for c in ("input", "output", "forward")]
+        z = policy_payload(b, ch, pre, [b.files[c] for c in files], t if before else ())
+        if z is None:
+            y = None
+            break
+        y.append((exe, z))
+    if y is not None:
+        for exe, z in y:
+            rc, out = fw_restore(exe, z)
+            if rc != 0:
+                dbot.logger.error(f"policy restore failed: {out}")
+                y = None
+                break
+    if y is None:
+        b.stop_firewall()
+        b.start_firewall()
+        return
+    b.update_logging(b.defaults["loglevel"])
+
+
+# >>> RULES
+
+
+def rules(command, replies):
+    """."""
+    if not verify(command.message):
+        return
+    ses = session(command)
+    alrt = ""
+    if ses.alert:
+        alrt = f"{ses.alert[0]}\n\n"
+        ses.alert.clear()
+    x = ruleset()
+    ses.state = "rules"
+    lst = x.listing
+    exp = ttl_pending()
+    if exp:
+        now = time.time()
+        lst = []
+        for c in x.recs:
+            d = exp.get(c.cmd.split(" comment '")[0])
+            d = f"  ⏱ {ttl_fmt(max(d - now, 0))}" if d is not None else ""
+            lst.append(f"🔹 {c.num}:  '{c.cmd}'{d}")
+        lst = "\n".join(lst)
+    y = ["\n\n", "", ""]
+    if len(x.recs) > 0:
+        y[2] = "\n🔺 /del  *rulenumber*\nDelete a rule.\n"
+    if len(x.recs) > 1:
+        y[0] = "\n🔺 /reset\nDelete all rules shown above.\n"
+        y[
+            1
+        ] = "\n🔺 /move  *rulenumber(s)*  *position*\nMoves existing rules (e.g. 12,13,14) to a specific position in one step.\n"
+    replies.add(
+        f"{alrt}🌐 RULES\n{lst}\n\n🔺 //  *ufw-command*  [ttl  *duration*]\nSpecify a valid ufw-command to add or insert allow/deny/reject/limit-rules or to delete rules.\nWith ttl (e.g. 30m, 2h, 1d) the rule is removed again after that time.\nPut one ufw-command per line to apply several at once, application rules only work one at a time.\n{y[2]}{y[0]}{y[1]}\n📖 rule syntax: https://is.gd/18ivdz"
+    )
+
+
+ropt = ("allow", "deny", "reject", "limit", "delete", "insert")
+
+
+def rules_parser():
+    p = ufwp.UFWParser()
+    for c in ropt:
+        p.register_command(ufwp.UFWCommandRule(c))
+    return p
+
+
+# returns the argument list for the parser or an alert
+def rules_args(line):
+    if "comment" in line:
+        plx = re.split("comment", line)
+        pl = [c for c in plx[0].split() if c.strip()]
+        cmt = [c for c in plx[1].split() if c.strip()]
+    else:
+        pl = [c for c in line.split() if c.strip()]
+        cmt = []
+    if len(pl) < 2:
+        return "⚠️ expects arguments"
+    elif pl[0] not in ropt:
+        return "⚠️ invalid *action*"
+    # add elif for insert but invalid action - length of pl has to be checked
+    if cmt:
+        pl.append("comment")
+        pl.append(" ".join(cmt))
+    return pl
+
+
+# maybe add check for proto any and port any and remove them as they will raise an ufw ERROR because of a long time unfixed bug
+def rules_pl(command, replies):
+    """."""
+    if not verify(command.message):
+        return
+    ses = session(command)
+    ses.state = "menu"
+    p = rules_parser()
+    lines = [c for c in command.payload.splitlines() if c.strip()]
+    if len(lines) > 1:
+        rules_batch(ses, p, lines)
+        rules(command, replies)
+        return
+    line, ttl = rules_ttl(command.payload)
+    pl = rules_args(line)
+    if isinstance(pl, str):
+        ses.alert.append(pl)
+    elif ttl is not None and (ttl <= 0 or pl[0] == "delete"):
+        ses.alert.append("⚠️ ttl expects a duration like 90m or 2h and a new rule")
+    else:
+        try:
+            pr = p.parse_command(pl)
+            if ttl:
+                rules_new(pr)
+                ttl_add(pr, ttl)
+                ses.alert.append(f"⏱ rule expires in {ttl_fmt(ttl)}")
+            else:
+                fw_do(pr)
+        except Exception as xcp:
+            ses.alert.append(f"⛔️ ufw exception: {xcp}")
+        except:
+            ses.alert.append("📛 ufw error")
+    rules(command, replies)
+
+
+# all lines are validated first, then applied in one transaction
+def rules_batch(ses, p, lines):
+    prs = []
+    ttls = []
+    for i, c in enumerate(lines, 1):
+        c, ttl = rules_ttl(c)
+        pl = rules_args(c)
+        if isinstance(pl, str):
+            ses.alert.append(f"{pl} (line {i})")
+            return
+        if ttl is not None and (ttl <= 0 or pl[0] == "delete"):
+            ses.alert.append(f"⚠️ ttl expects a duration like 90m or 2h and a new rule (line {i})")
+            return
+        ttls.append(ttl)
+        try:
+            prs.append(p.parse_command(pl))
+        except Exception as xcp:
+            ses.alert.append(f"⛔️ ufw exception: {xcp} (line {i})")
+            return
+    i = 0
+    try:
+        with Txn() as t:
+            for i, pr in enumerate(prs, 1):
+                if not t.apply(pr) and ttls[i - 1]:
+                    raise ufwc.UFWError(rexist)
+            i = 0
+            t.commit()
+    except Exception as xcp:
+        x = f" (line {i})" if i else ""
+        ses.alert.append(f"⛔️ ufw exception: {xcp}{x}\nnothing was changed")
+        return
+    for pr, ttl in zip(prs, ttls):
+        if ttl:
+            ttl_add(pr, ttl)
+    ses.alert.append(f"🔸 {len(prs)} ufw-commands applied with a single reload")
+
+
+# an existing rule would be removed with the ttl of the new one
+rexist = "the rule exists already, ttl only works for new rules"
+
+
+def rules_new(pr):
+    with Txn() as t:
+        if not t.apply(pr):
+            raise ufwc.UFWError(rexist)
+        t.commit()
+
+
+def rules_del(command, replies):
+    """."""
+    if not verify(command.message):
+        return
+    ses = session(command)
+    ses.state = "menu"
+    p = ufwp.UFWParser()
+    p.register_command(ufwp.UFWCommandRule("delete"))
+    pl = [c for c in command.payload.split() if c.strip()]
+    if len(pl) != 1:
+        ses.alert.append("⚠️ expects one argument")
+    elif not pl[0].isnumeric():
+        ses.alert.append("⚠️ argument must be numeric")
+    elif not 0 < int(pl[0]) <= fw()[1].get_rules_count(False):
+        ses.alert.append("⚠️ argument must be valid rulenumber")
+    else:
+        try:
+            pr = p.parse_command(["delete", pl[0]])
+            fw_do(pr)
+        except Exception as xcp:
+            ses.alert.append(f"⛔️ ufw exception: {xcp}")
+        except:
+            ses.alert.append("📛 ufw error")
+    rules(command, replies)
+
+
+def rules_rst(command, replies):
+    """."""
+    if not verify(command.message):
+        return
+    ses = session(command)
+    ses.state = "menu"
+    try:
+        with Txn() as t:
+            t.clear()
+            t.commit()
+    except Exception as xcp:
+        ses.alert.append(f"⛔️ ufw exception: {xcp}\nprevious rules restored")
+    except:
+        ses.alert.append("📛 ufw error")
+    rules(command, replies)
+
+
+def rules_mv(command, replies):
+    """."""
+    if not verify(command.message):
+        return
+    ses = session(command)
+    ses.state = "menu"
+    pl = [c for c in command.payload.split() if c.strip()]
+    if len(pl) != 2:
+        ses.alert.append("⚠️ expects two arguments")
+        rules(command, replies)
+        return
+    y = [c for c in pl[0].split(",") if c.strip()]
+    x = len(ruleset().recs)
+    if not all([c.isnumeric() for c in y + [pl[1]]]):
+        ses.alert.append("⚠️ arguments must be numeric")
+    else:
+        y = [int(c) for c in y]
+        z = int(pl[1])
+        if not (
+            y
+            and len(set(y)) == len(y)
+            and all([0 < c <= x for c in y])
+            and 0 < z <= x - len(y) + 1
+        ):
+            # could be more elaborate
+            ses.alert.append("⚠️ invalid argument(s)")
+        else:
+            try:
+                with Txn() as t:
+                    t.move(y, z)
+                    t.commit()
+            except Exception as xcp:
+                ses.alert.append(f"⛔️ ufw exception: {xcp}")
+            except:
+                ses.alert.append("📛 ufw error")
+    rules(command, replies)
+
+
+# >>> EXPIRY
+
+lpat = re.compile(r"\s+ttl\s+((?:\d+[smhd])+)\s*$")
+lsec = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+# '1h30m' in seconds, None if it isn't a duration
+def dur_secs(x):
+    if not re.fullmatch(r"(?:\d+[smhd])+", x):
+        return None
+    return sum([int(a) * lsec[b] for a, b in re.findall(r"(\d+)([smhd])", x)])
+
+
+# the line without its ttl suffix and the ttl in seconds or None
+def rules_ttl(line):
+    m = lpat.search(line)
+    if not m:
+        if re.search(r"\sttl(\s|$)", line.split("comment")[0]):
+            return (line, 0)
+        return (line, None)
+    return (line[: m.start()], dur_secs(m.group(1)))
+
+
+def ttl_fmt(x):
+    x = int(x)
+    if x >= 86400:
+        return f"{x // 86400}d {x % 86400 // 3600}h"
+    if x >= 3600:
+        return f"{x // 3600}h {x % 3600 // 60}m"
+    if x >= 60:
+        return f"{x // 60}m"
+    return f"{x}s"
+
+
+# rules are found again by their command, a comment doesn't take part
+def ttl_cmd(rule):
+    return ufwp.UFWCommandRule.get_command(rule).split(" comment '")[0]
+
+
+def ttl_add(pr, ttl):
+    due = time.time() + ttl
+    cmd = ttl_cmd(pr.data["rule"])
+    with dblock:
+        c = store()
+        c.execute("INSERT OR REPLACE INTO expiry (due, cmd) VALUES (?, ?)", (due, cmd))
+        x = c.execute("SELECT id FROM expiry WHERE cmd = ?", (cmd,)).fetchone()[0]
+    expiry.add(due, x)
+
+
+def ttl_pending():
+    with dblock:
+        return dict([(c, d) for d, c in store().execute("SELECT due, cmd FROM expiry")])
+
+
+# runs on the mutation worker, all due rules go in one reload, rules that
+# are gone already are just forgotten, rules that fail to delete are kept
+# and tried again in an hour
+def ttl_expire(ids):
+    now = time.time()
+    q = ",".join("?" * len(ids))
+    with dblock:
+        x = store().execute(
+            f"SELECT id, cmd FROM expiry WHERE id IN ({q}) AND due <= ?", (*ids, now)
+        ).fetchall()
+    if not x:
+        return
+    p = rules_parser()
+    y = []
+    bad = []
+    try:
+        with Txn() as t:
+            for i, c in x:
+                w = t.numbered()
+                try:
+                    t.apply(p.parse_command(["delete", *rules_args(c)]), missing_ok=True)
+                except Exception as xcp:
+                    # no ip version of it is deleted if one fails
+                    t.assign(w)
+                    bad.append((i, c, xcp))
+                    continue
+                if len(t.numbered()) < len(w):
+                    y.append(c)
+            if y:
+                t.commit()
+    except Exception as xcp:
+        dbot.logger.exception(xcp)
+        admins(f"⛔️ ufw exception: {xcp}\n{len(x)} expired rules were not removed")
+        expiry.add(now + 60, *[i for i, _ in x])
+        return
+    # only the rows read above, others may have been set again meanwhile
+    z = [i for i, _ in x if i not in [j for j, _, _ in bad]]
+    with dblock:
+        store().execute(
+            f"DELETE FROM expiry WHERE id IN ({','.join('?' * len(z))}) AND due <= ?", (*z, now)
+        )
+    if bad:
+        expiry.add(now + 3600, *[i for i, _, _ in bad])
+        w = "\n".join([f"🔸 '{c}': {xcp}" for _, c, xcp in bad])
+        admins(f"⛔️ ufw exception\n{len(bad)} expired rules were not removed, next try in 1h\n{w}")
+    if y:
+        y = "\n".join([f"🔹 '{c}'" for c in y])
+        admins(f"⏱ EXPIRED\n{y}")
+
+
+class Expiry:
+    """Pending rule expiries in a heap, one thread sleeps until the earliest.
+
+    Entries are (due, id) of the expiry table, entries replaced meanwhile
+    are skipped by ttl_expire(). Due ones are handed to the mutation
+    worker in one batch.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.cond = threading.Condition()
+
+    def start(self):
+        with dblock:
+            x = store().execute("SELECT due, id FROM expiry").fetchall()
+        with self.cond:
+            self.heap = [tuple(c) for c in x]
+            heapq.heapify(self.heap)
+        threading.Thread(target=self.run, name="fwbot-expiry", daemon=True).start()
+
+    def add(self, due, *ids):
+        with self.cond:
+            for c in ids:
+                heapq.heappush(self.heap, (due, c))
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.heap or self.heap[0][0] > time.time():
+                    self.cond.wait(self.heap[0][0] - time.time() if self.heap else None)
+                now = time.time()
+                x = []
+                while self.heap and self.heap[0][0] <= now:
+                    x.append(heapq.heappop(self.heap)[1])
+            wq.put(partial(ttl_expire, x))
+
+
+expiry = Expiry()
+
+
+# >>> OPTIMIZE
+
+# a field opt_pass() merges over and the position of that field in opt_key()
+ofld = {"dport": 7, "src": 4, "dst": 5}
+
+
+def opt_key(r, f):
+    x = [
+        r.action,
+        r.direction,
+        r.v6,
+        r.protocol,
+        r.src,
+        r.dst,
+        r.sport,
+        r.dport,
+        r.interface_in,
+        r.interface_out,
+        r.logtype,
+        getattr(r, "comment", ""),
+        getattr(r, "forward", False),
+    ]
+    x[ofld[f]] = None
+    return tuple(x)
+
+
+def opt_ok(r, f):
+    if r.dapp or r.sapp or r.action == "limit":
+        return False
+    if f != "dport":
+        return rule_net(getattr(r, f)) is not None
+    if r.protocol not in ("tcp", "udp"):
+        return False
+    try:
+        return port_ranges(r.dport) is not None
+    except ValueError:
+        return False
+
+
+# sorted ranges with overlapping and adjacent ones joined, split into specs
+# of at most 15 multiport slots (a range takes two)
+def opt_ports(x):
+    y = []
+    for lo, hi in sorted(x):
+        if y and lo <= y[-1][1] + 1:
+            y[-1][1] = max(y[-1][1], hi)
+        else:
+            y.append([lo, hi])
+    z = [[]]
+    n = 0
+    for lo, hi in y:
+        w = 1 if lo == hi else 2
+        if n + w > 15:
+            z.append([])
+            n = 0
+        z[-1].append(f"{lo}" if lo == hi else f"{lo}:{hi}")
+        n += w
+    return [",".join(c) for c in z]
+
+
+# rules with the same key are merged into the first of them unless a rule in
+# between could see the same packets with another action
+def opt_pass(x, f):
+    sh = [RuleShape(r) for r, _ in x]
+    cur = {}
+    groups = []
+    for j, (r, _) in enumerate(x):
+        if not opt_ok(r, f):
+            continue
+        k = opt_key(r, f)
+        g = cur.get(k)
+        if g is not None:
+            ok = True
+            for i in range(g[0] + 1, j):
+                y = x[i][0]
+                if i not in g and (y.action, y.logtype) != (r.action, r.logtype):
+                    if sh[i].overlaps(sh[j]):
+                        ok = False
+                        break
+            if ok:
+                g.append(j)
+                continue
+        cur[k] = [j]
+        groups.append(cur[k])
+    heads = {}
+    drop = set()
+    for g in groups:
+        if len(g) < 2:
+            continue
+        rs = [x[i][0] for i in g]
+        nums = tuple(sorted(set().union(*[x[i][1] for i in g])))
+        y = []
+        if f == "dport":
+            for c in opt_ports([d for r in rs for d in port_ranges(r.dport)]):
+                r = rs[0].dup_rule()
+                r.set_port(c, "dst")
+                y.append(r)
+        else:
+            for c in ipaddress.collapse_addresses([rule_net(getattr(r, f)) for r in rs]):
+                r = rs[0].dup_rule()
+                if f == "src":
+                    r.set_src(str(c))
+                else:
+                    r.set_dst(str(c))
+                y.append(r)
+        if len(y) >= len(g):
+            continue
+        heads[g[0]] = [(r, nums) for r in y]
+        drop.update(g[1:])
+    z = []
+    for i, c in enumerate(x):
+        if i in heads:
+            z.extend(heads[i])
+        elif i not in drop:
+            z.append(c)
+    return z
+
+
+# the merged rules and for every merge the /rules numbers it replaces
+def opt_plan(rules):
+    x = [(r, (i,)) for i, r in enumerate(rules, 1)]
+    while True:
+        n = len(x)
+        for f in ofld:
+            x = opt_pass(x, f)
+        if len(x) == n:
+            break
+    y = OrderedDict()
+    for r, nums in x:
+        if len(nums) > 1:
+            y.setdefault(nums, []).append(ufwp.UFWCommandRule.get_command(r))
+    return ([r for r, _ in x], y)
+
+
+def optimize(command, replies):
+    """."""
+    if not verify(command.message):
+        return
+    ses = session(command)
+    alrt = ""
+    if ses.alert:
+        alrt = f"{ses.alert[0]}\n\n"
+        ses.alert.clear()
+    x = ruleset()
+    y, z = opt_plan([c.rule for c in x.recs])
+    # /apply commits exactly this, as long as the rules stay the same
+    ses.plan = (x.version, y)
+    ses.state = "optimize"
+    if not z:
+        replies.add(f"{alrt}🌐 OPTIMIZE\n🔹 rules:  '{len(x.recs)}'\n\n🔸 nothing to merge")
+        return
+    z = "\n".join([f"🔸 {', '.join(map(str, c))}  ->  '" + "', '".join(d) + "'" for c, d in z.items()])
+    replies.add(
+        f"{alrt}🌐 OPTIMIZE\n🔹 rules:  '{len(x.recs)}'\n🔹 optimized:  '{len(y)}'\n\n{z}\n\n🔺 /apply\nReplaces the merged rules in one step."
+    )
+
+
+def optimize_apply(command, replies):
+    """."""
+    if not verify(command.message):
+        return
+    ses = session(command)
+    ses.state = "menu"
+    x, ses.plan = ses.plan, None
+    try:
+        y = ruleset()
+        if x is None or x[0] != y.version:
+            ses.alert.append("⚠️ rules changed since /optimize, nothing applied, check the new plan")
+        elif len(x[1]) < len(y.recs):
+            with Txn() as t:
+                t.assign([r.dup_rule() for r in x[1]])
+                t.commit()
+    except Exception as xcp:
+        ses.alert.append(f"⛔️ ufw exception: {xcp}")
+    except:
+        ses.alert.append("📛 ufw error")
+    optimize(command, replies)
+
+
+# >>> LINT
+
+
+class LintChain:
+    """Earlier rules of one chain by destination port, source and destination.
+
+    Each index gives the rules that may overlap a new one, the smallest of
+    these candidate sets is checked against the others and then confirmed
+    with RuleShape.
+    """
+
+    __slots__ = ("seen", "anyport", "ports", "tries", "loose")
+
+    def __init__(self):
+        self.seen = []
+        self.anyport = set()
+        self.ports = PortTree()
+        self.tries = (CidrTrie(), CidrTrie())
+        self.loose = (set(), set())
+
+    def add(self, i, s):
+        self.seen.append(i)
+        if s.dports is None:
+            self.anyport.add(i)
+        else:
+            for lo, hi in s.dports:
+                self.ports.add(lo, hi, i)
+        for c, d, e in zip((s.src, s.dst), self.tries, self.loose):
+            if c is None:
+                e.add(i)
+            else:
+                d.add(c, i)
+
+    # each index yields a pair of sets, indexes that can't narrow are left out
+    def candidates(self, s):
+        x = []
+        if s.dports is not None:
+            y = set()
+            for lo, hi in s.dports:
+                y.update(self.ports.span(lo, hi))
+            x.append((self.anyport, y))
+        for c, d, e in zip((s.src, s.dst), self.tries, self.loose):
+            if c is not None and c.prefixlen > 0:
+                y = set()
+                for z in d.covering(c) + d.inside(c):
+                    y.update(z)
+                x.append((e, y))
+        if not x:
+            return self.seen
+        x.sort(key=lambda c: sum(map(len, c)))
+        y = set().union(*x[0])
+        for c in x[1:]:
+            y = (y & c[0]) | (y & c[1])
+        return sorted(y)
+
+
+# per rule index the earlier rule covering it or the first few earlier rules
+# it overlaps with another action, shadowed and redundant rules never match
+def lint_run(rules):
+    x = [RuleShape(r) for r in rules]
+    chains = {}
+    found = []
+    for j, s in enumerate(x):
+        n = chains.get(s.chain)
+        if n is None:
+            n = chains[s.chain] = LintChain()
+        y = []
+        for i in n.candidates(s):
+            if x[i].covers(s):
+                if rules[i].action == rules[j].action:
+                    found.append((j, "redundant", [i]))
+                else:
+                    found.append((j, "shadowed", [i]))
+                y = None
+                break
+            if len(y) < 6 and rules[i].action != rules[j].action and x[i].overlaps(s):
+                y.append(i)
+        if y:
+            found.append((j, "conflicting", y))
+        n.add(j, s)
+    return found
+
+
+def lint(command, replies):
+    """."""
+    if not verify(command.message):
+        return
+    ses = session(command)
+    ses.state = "menu"
+    x = ruleset()
+    y = lint_run([c.rule for c in x.recs])
+    z = []
+    for j, c, d in y[:50]:
+        e = ", ".join([str(i + 1) for i in d[:5]])
+        if len(d) > 5:
+            e += ", ..."
+        if c == "conflicting":
+            z.append(f"🔸 {j + 1}: conflicting, overlaps {e} with another action")
+        elif c == "shadowed":
+            z.append(f"🔸 {j + 1}: shadowed, never matches because of {e}")
+        else:
+            z.append(f"🔸 {j + 1}: redundant, {e} already matches everything")
+    if len(y) > 50:
+        z.append(f"🔸 ... and {len(y) - 50} more")
+    if not z:
+        z.append("🔸 no findings")
+    z = "\n".join(z)
+    replies.add(f"🌐 LINT\n🔹 rules:  '{len(x.recs)}'\n🔹 findings:  '{len(y)}'\n\n{z}")
+
+
+# >>> TEST
+
+
+class Classifier:
+    """The user rules compiled for packet lookups.
+
+    Rules are bucketed by ip version, direction and protocol, each bucket
+    has a PortTree on the destination ports and prefix tries on source and
+    destination. The lowest rule index matching all of them decides, like
+    the first matching rule in the user chains. Application rules and rules
+    with fields that can't be parsed are left out and counted in skipped.
+    """
+
+    def __init__(self, recs):
+        self.recs = recs
+        self.shapes = []
+        self.buckets = {}
+        self.skipped = 0
+        for i, c in enumerate(recs):
+            s = RuleShape(c.rule)
+            self.shapes.append(s)
+            if not s.exact or s.chain[2]:
+                self.skipped += 1
+                continue
+            k = (s.chain[0], s.chain[1], s.proto)
+            x = self.buckets.get(k)
+            if x is None:
+                x = self.buckets[k] = (set(), PortTree(), CidrTrie(), CidrTrie())
+            if s.dports is None:
+                x[0].add(i)
+            else:
+                for lo, hi in s.dports:
+                    x[1].add(lo, hi, i)
+            x[2].add(s.src, i)
+            x[3].add(s.dst, i)
+
+    # index of the deciding rule or None for the default policy
+    def decide(self, pk):
+        x = None
+        for c in {pk.proto, "any"}:
+            y = self.buckets.get((pk.v6, pk.direction, c))
+            if y is None:
+                continue
+            z = set(y[0])
+            if pk.dport is not None:
+                z.update(y[1].stab(pk.dport))
+            for t, a in ((y[2], pk.src), (y[3], pk.dst)):
+                if not z:
+                    break
+                w = set()
+                for d in t.covering(a):
+                    w.update(d)
+                z &= w
+            for i in sorted(z):
+                if x is not None and i >= x:
+                    break
+                s = self.shapes[i]
+                if s.sports is not None and (
+                    pk.sport is None or not any([lo <= pk.sport <= hi for lo, hi in s.sports])
+                ):
+                    continue
+                f = s.iface[0] if pk.direction == "in" else s.iface[1]
+                if f and f != pk.iface:
+                    continue
+                x = i
+                break
+        return x
+
+
+# rebuilt when /rules would show another ruleset
+tcx = {"version": None, "cls": None}
+
+
+def classifier():
+    x = ruleset()
+    if tcx["version"] != x.version:
+        tcx["cls"] = Classifier(x.recs)
+        tcx["version"] = x.version
+    return tcx["cls"]
+
+
+class Packet:
+    __slots__ = ("direction", "proto", "v6", "src", "sport", "dst", "dport", "iface", "expect")
+
+
+tpat = re.compile(
+    r"^(in|out)\s+(\w+)\s+(\S+?)\s*->\s*(\S+?)(?:\s+on\s+(\S+))?(?:\s*=\s*(\w+))?$"
+)
+
+
+# 10.0.0.5, 10.0.0.5:22, 2001:db8::1 or [2001:db8::1]:22
+def test_addr(x):
+    y = None
+    if x.startswith("["):
+        x, _, y = x[1:].partition("]")
+        y = y[1:] if y.startswith(":") else None
+    elif x.count(":") == 1:
+        x, _, y = x.partition(":")
+    a = ipaddress.ip_address(x)
+    if y is not None:
+        y = int(y)
+        if not 0 <= y <= 65535:
+            raise ValueError(y)
+    return (ipaddress.ip_network(a), y)
+
+
+def test_parse(line):
+    m = tpat.match(line.strip())
+    if not m:
+        return None
+    x = Packet()
+    x.direction, x.proto = m.group(1), m.group(2).lower()
+    try:
+        x.src, x.sport = test_addr(m.group(3))
+        x.dst, x.dport = test_addr(m.group(4))
+    except ValueError:
+        return None
+    if x.src.version != x.dst.version:
+        return None
+    x.v6 = x.dst.version == 6
+    x.iface = m.group(5)
+    x.expect = m.group(6)
+    return x
+
+
+def test(command, replies):
+    """."""
+    if not verify(command.message):
+        return
+    ses = session(command)
+    ses.state = "menu"
+    lines = [c for c in command.payload.splitlines() if c.strip()]
+    x = "\n\n🔺 /test  *in|out*  *protocol*  *src[:port]*  ->  *dst[:port]*  [on *interface*]  [= *action*]\nShows the rule that decides a packet and its action, the default policy if none does. Put one packet per line to test several, with = *action* the result is checked."
+    if not lines:
+        replies.add(f"🌐 TEST{x}")
+        return
+    pks = []
+    for i, c in enumerate(lines, 1):
+        pk = test_parse(c)
+        if pk is None:
+            replies.add(f"⚠️ invalid packet (line {i}){x}")
+            return
+        pks.append(pk)
+    cls = classifier()
+    b = fw()[1]
+    pol = {"in": b._get_default_policy("input"), "out": b._get_default_policy("output")}
+    y = []
+    n = 0
+    for i, pk in enumerate(pks, 1):
+        j = cls.decide(pk)
+        if j is None:
+            v = pol[pk.direction]
+            z = f"'{v}' by default policy"
+        else:
+            v = cls.recs[j].rule.action
+            z = f"'{v}' by rule {cls.recs[j].num}"
+            if len(pks) == 1:
+                z += f"\n🔸 '{cls.recs[j].cmd}'"
+        if pk.expect:
+            if pk.expect == v:
+                n += 1
+                z += "  ✅"
+            else:
+                z += f"  ❌ expected '{pk.expect}'"
+        y.append((i, z))
+    e = [pk for pk in pks if pk.expect]
+    z = [f"🔹 packets:  '{len(pks)}'"]
+    if e:
+        z.append(f"🔹 passed:  '{n}/{len(e)}'")
+    if cls.skipped:
+        z.append(f"🔹 not evaluated:  '{cls.skipped} rules'")
+    z = "\n".join(z)
+    # long batches only list what didn't pass
+    w = [c for c in y if "✅" not in c[1]] if len(pks) > 50 else y
+    w = "\n".join([f"🔸 {i}: {c}" for i, c in w[:50]])
+    replies.add(f"🌐 TEST\n{z}\n\n{w}")
+
+
+# what decides a packet from outside to a local address and port
+def test_outside(cls, pol, proto, addr, port):
+    pk = Packet()
+    pk.direction, pk.proto, pk.v6, pk.iface = "in", proto, addr.version == 6, None
+    pk.src = ipaddress.ip_network("203.0.113.1" if addr.version == 4 else "2001:db8::1")
+    pk.sport = None
+    pk.dst = ipaddress.ip_network(addr)
+    pk.dport = port
+    j = cls.decide(pk)
+    if j is None:
+        return (pol, f"policy {pol}")
+    x = cls.recs[j].rule.action
+    return (x, f"rule {cls.recs[j].num} {x}s")
+
+
+# >>> HOT
+
+# chains ufw writes the user rules to
+hchn = ("user-input", "user-output", "user-forward")
+
+
+# packets and bytes per line of the user chains from one iptables-save -c,
+# lines without a verdict (logging, recent --set) are counted as None, so is
+# the over the limit jump of a limit rule, it is counted by its accept jump
+def hot_live(exe, pre):
+    x = {f"{pre}-{c}": [] for c in hchn}
+    try:
+        p = subprocess.run([exe, "-c", "-t", "filter"], capture_output=True, text=True, check=False)
+    except OSError:
+        return None
+    if p.returncode != 0:
+        return None
+    for c in p.stdout.splitlines():
+        if not c.startswith("["):
+            continue
+        y, _, z = c.partition("] -A ")
+        d, _, e = z.partition(" ")
+        if d not in x:
+            continue
+        t = e.rpartition(" -j ")[2].split(" ")[0] if " -j " in e else ""
+        if not t or t == "LOG" or "-logging-" in t or t == f"{pre}-user-limit":
+            x[d].append(None)
+        else:
+            a, _, b = y[1:].partition(":")
+            x[d].append((int(a), int(b)))
+    return x
+
+
+# rule index per line of the user chains, rules follow their ### tuple ###
+def hot_file(path, pre):
+    x = {f"{pre}-{c}": [] for c in hchn}
+    k = None
+    n = -1
+    with open(path) as f:
+        for c in f:
+            if c.startswith("### tuple ###"):
+                n += 1
+                k = n
+            elif c.startswith("### END RULES ###"):
+                k = None
+            elif c.startswith("-A "):
+                d = c.split(None, 2)[1]
+                if d in x:
+                    x[d].append(k)
+    return x
+
+
+# (packets, bytes) per rule numbered like /rules, None if the loaded chains
+# don't match the rules files
+def hot_counts():
+    b = fw()[1]
+    x = [
+        (b.files["rules"], f"{b.iptables}-save", "ufw", len(b.rules)),
+        (b.files["rules6"], f"{b.ip6tables}-save", "ufw6", len(b.rules6)),
+    ]
+    y = []
+    for path, exe, pre, n in x:
+        z = [(0, 0)] * n
+        if pre == "ufw6" and not b.use_ipv6():
+            y += z
+            continue
+        live = hot_live(exe, pre)
+        if live is None:
+            return None
+        for c, d in hot_file(path, pre).items():
+            if len(d) != len(live[c]):
+                return None
+            for k, e in zip(d, live[c]):
+                if k is not None and e is not None and k < n:
+                    z[k] = (z[k][0] + e[0], z[k][1] + e[1])
+        y += z
+    return y
+
+
+# a rule moves up past colder rules of its chain as long as none of them can
+# see its packets with another action, returns the new order of indexes
+def hot_plan(rules, hits):
+    sh = [RuleShape(r) for r in rules]
+    x = list(range(len(rules)))
+    for j in range(len(x)):
+        i = x[j]
+        if not hits[i]:
+            continue
+        pos = j
+        k = j
+        while k > 0:
+            y = x[k - 1]
+            # ipv6 rules stay behind the ipv4 rules
+            if sh[y].chain[0] != sh[i].chain[0]:
+                break
+            if sh[y].chain != sh[i].chain:
+                k -= 1
+                continue
+            if hits[y] >= hits[i]:
+                break
+            if (rules[y].action, rules[y].logtype) != (rules[i].action, rules[i].logtype):
+                if sh[y].overlaps(sh[i]):
+                    break
+            k -= 1
+            pos = k
+        if pos != j:
+            x[pos:j + 1] = [i] + x[pos:j]
+    return x
+
+
+# rules a packet passes in its chain on average
+def hot_depth(rules, hits, order):
+    x = {}
+    n = 0
+    d = 0
+    for i in order:
+        c = (rules[i].v6, rules[i].direction, getattr(rules[i], "forward", False))
+        x[c] = x.get(c, 0) + 1
+        n += hits[i]
+        d += hits[i] * x[c]
+    return d / n if n else 0.0
+
+
+def hot_num(n):
+    for c in ("", "K", "M", "G"):
+        if n < 1000:
+            return f"{n:.0f}{c}" if c == "" else f"{n:.1f}{c}"
+        n /= 1000
+    return f"{n:.1f}T"
+
+
+def hot(command, replies):
+    """."""
+    if not verify(command.message):
+        return
+    ses = session(command)
+    alrt = ""
+    if ses.alert:
+        alrt = f"{ses.alert[0]}\n\n"
+        ses.alert.clear()
+    if not fw()[1].is_enabled():
+        ses.state = "menu"
+        replies.add(f"{alrt}🌐 HOT\n🔸 firewall is inactive, no counters")
+        return
+    y = hot_counts()
+    if y is None:
+        ses.state = "menu"
+        replies.add(f"{alrt}🌐 HOT\n🔸 loaded chains don't match the rules files, reload ufw first")
+        return
+    x = ruleset()
+    rules = [c.rule for c in x.recs]
+    if len(rules) != len(y):
+        ses.state = "menu"
+        replies.add(f"{alrt}🌐 HOT\n🔸 rules changed meanwhile, try again")
+        return
+    hits = [c[0] for c in y]
+    z = sorted([i for i in range(len(y)) if hits[i]], key=lambda i: -hits[i])[:10]
+    w = [f"🔸 {i + 1}: {hot_num(y[i][0])} packets, {hot_num(y[i][1])}B  '{x.recs[i].cmd}'" for i in z]
+    if not w:
+        w.append("🔸 no packets matched a rule yet")
+    w = "\n".join(w)
+    order = hot_plan(rules, hits)
+    e = [f"🔹 packets:  '{hot_num(sum(hits))}'"]
+    ses.state = "hot"
+    if order == list(range(len(rules))):
+        replies.add(f"{alrt}🌐 HOT\n{e[0]}\n\n{w}")
+        return
+    new = {i: k for k, i in enumerate(order, 1)}
+    v = [f"🔸 {i + 1} -> {new[i]}" for i in order if new[i] < i + 1]
+    e.append(f"🔹 depth:  '{hot_depth(rules, hits, range(len(rules))):.1f}' -> '{hot_depth(rules, hits, order):.1f}'")
+    e = "\n".join(e)
+    v = "\n".join(v[:20])
+    replies.add(
+        f"{alrt}🌐 HOT\n{e}\n\n{w}\n\n{v}\n\n🔺 /apply\nMoves the hot rules up in one step, counters start over."
+    )
+
+
+def hot_apply(command, replies):
+    """."""
+    if not verify(command.message):
+        return
+    ses = session(command)
+    ses.state = "menu"
+    try:
+        with Txn() as t:
+            x = t.numbered()
+            y = hot_counts()
+            if y is None or len(y) != len(x):
+                raise ufwc.UFWError("loaded chains don't match the rules files")
+            order = hot_plan(x, [c[0] for c in y])
+            if order != list(range(len(x))):
+                t.assign([x[i] for i in order])
+                t.commit()
+    except Exception as xcp:
+        ses.alert.append(f"⛔️ ufw exception: {xcp}")
+    except:
+        ses.alert.append("📛 ufw error")
+    hot(command, replies)
+
+
+# >>> BLOCKLISTS
+
+# a blocklist NAME is the ipset hash:net pair fwbot-NAME and fwbot6-NAME, one
+# DROP rule per set in before(6).rules references it, so changing the sets
+# never reloads a chain
+bpat = re.compile(r"^[A-Za-z0-9_]{1,20}$")
+bmrk = "# End required lines"
+
+
+def block_sets(name):
+    return (f"fwbot-{name}", f"fwbot6-{name}")
+
+
+def block_ipset(*args, payload=None):
+    try:
+        p = subprocess.run(
+            ["ipset", *args], input=payload, capture_output=True, text=True, check=False
+        )
+    except OSError:
+        raise ufwc.UFWError("ipset is not installed")
+    if p.returncode != 0:
+        raise ufwc.UFWError(f"ipset {args[0]}: {p.stderr.strip()}")
+    return p.stdout
+
+
+def block_hook(name, v6):
+    x = block_sets(name)[v6]
+    pre = "ufw6" if v6 else "ufw"
+    return [f"-A {pre}-before-{c} -m set --match-set {x} src -j DROP" for c in ("input", "forward")]
+
+
+def block_write(path, text):
+    m = os.stat(path).st_mode if os.path.exists(path) else 0o640
+    with open(f"{path}.fwbot", "wb" if isinstance(text, bytes) else "w") as f:
+        f.write(text)
+    os.chmod(f"{path}.fwbot", m)
+    os.replace(f"{path}.fwbot", path)
+
+
+# the hook goes right behind ufw's required lines, first in the before chains
+def block_file(path, name, v6, add):
+    tag = f"# fwbot blocklist {name}"
+    if not add and not os.path.exists(path):
+        return
+    with open(path) as f:
+        x = f.read().splitlines()
+    y = []
+    skip = False
+    for c in x:
+        if c == tag:
+            skip = True
+            continue
+        if skip and f"--match-set {block_sets(name)[v6]} " in c:
+            continue
+        skip = False
+        y.append(c)
+    if add:
+        k = [i for i, c in enumerate(y) if c.startswith(bmrk)]
+        if not k:
+            raise ufwc.UFWError(f"'{bmrk}' not found in {path}")
+        y[k[0] + 1 : k[0] + 1] = [tag, *block_hook(name, v6)]
+    if y != x:
+        block_write(path, "\n".join(y) + "\n")
+
+
+# the same rules in the loaded chains, without a reload
+def block_live(b, name, add):
+    if not b.is_enabled():
+        return
+    x = [(False, b.iptables)]
+    if b.use_ipv6():
+        x.append((True, b.ip6tables))
+    for v6, exe in x:
+        for c in block_hook(name, v6):
+            y = c.split()[1:]
+            have = subprocess.run([exe, "-C", *y], capture_output=True).returncode == 0
+            if add and not have:
+                z = [exe, "-I", y[0], "1", *y[1:]]
+            elif not add and have:
+                z = [exe, "-D", *y]
+            else:
+                continue
+            rc, out = ufwu.cmd(z)
+            if rc != 0:
+                raise ufwc.UFWError(f"problem running {os.path.basename(exe)}: {out}")
+
+
+# the sets are saved next to the rules and restored by before.init, ufw loads
+# before.rules right after it
+def block_paths(b):
+    x = os.path.dirname(b.files["before_rules"])
+    return (os.path.join(x, "fwbot.ipset"), os.path.join(x, "before.init"))
+
+
+def block_save(b):
+    save, init = block_paths(b)
+    x = []
+    for c in block_ipset("save").splitlines():
+        y = c.split()
+        if len(y) > 1 and y[0] in ("create", "add") and y[1].startswith(("fwbot-", "fwbot6-")):
+            x.append(c)
+    block_write(save, "\n".join(x) + "\n")
+    line = f'[ "$1" = start ] && [ -r {save} ] && ipset restore -exist -f {save}'
+    try:
+        with open(init) as f:
+            y = f.read().splitlines()
+    except FileNotFoundError:
+        y = ["#!/bin/sh"]
+    if line in y:
+        return
+    k = 1 if y and y[0].startswith("#!") else 0
+    y[k:k] = ["# fwbot blocklists", line]
+    block_write(init, "\n".join(y) + "\n")
+    os.chmod(init, os.stat(init).st_mode | 0o755)
+
+
+# with timeout each entry can be given its own lifetime, an existing set is
+# kept as it is unless it lacks timeouts that are needed
+def block_create(b, name, timeout=False):
+    have = set(block_ipset("list", "-n").split())
+    for c, d in zip(block_sets(name), ("inet", "inet6")):
+        if c not in have:
+            x = ["timeout", "0"] if timeout else []
+            block_ipset("create", c, "hash:net", "family", d, *x)
+        elif timeout and " timeout " not in f"{block_header(c)} ":
+            block_timeout(c, d)
+    block_file(b.files["before_rules"], name, False, True)
+    block_file(b.files["before6_rules"], name, True, True)
+    block_live(b, name, True)
+
+
+def block_header(c):
+    for x in block_ipset("list", "-t", c).splitlines():
+        if x.startswith("Header:"):
+            return x
+    return ""
+
+
+# a set made by /block gets timeouts through a copy that is swapped in, the
+# rules keep referring to it by name
+def block_timeout(c, fam):
+    t = f"{c}-new"
+    block_ipset("create", t, "hash:net", "family", fam, "timeout", "0", "-exist")
+    block_ipset("flush", t)
+    x = [f"add {t} {y.split()[2]}" for y in block_ipset("save", c).splitlines() if y.startswith("add ")]
+    if x:
+        block_ipset("restore", "-exist", payload="\n".join(x) + "\n")
+    block_ipset("swap", t, c)
+    block_ipset("destroy", t)
+
+
+def block_destroy(b, name):
+    block_live(b, name, False)
+    block_file(b.files["before_rules"], name, False, False)
+    block_file(b.files["before6_rules"], name, True, False)
+    for c in block_sets(name):
+        with suppress(ufwc.UFWError):
+            block_ipset("destroy", c)
+
+
+# networks of an iterable of tokens, collapsed per ip version, and the number
+# of tokens that are no address
+def block_nets(tokens):
+    x = ([], [])
+    bad = 0
+    for c in tokens:
+        try:
+            y = ipaddress.ip_network(c, strict=False)
+        except ValueError:
+            bad += 1
+            continue
+        if y.prefixlen == 0:
+            bad += 1
+            continue
+        x[y.version == 6].append(y)
+    return ([list(ipaddress.collapse_addresses(c)) for c in x], bad)
+
+
+def block_tokens(path):
+    with open(path) as f:
+        for c in f:
+            c = c.split("#", 1)[0].replace(",", " ")
+            yield from c.split()
+
+
+# streamed into one ipset restore, no matter the size
+def block_restore(op, name, nets, timeout=None):
+    p = subprocess.Popen(
+        ["ipset", "restore", "-exist"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        x = f" timeout {timeout}" if timeout else ""
+        for c, d in zip(block_sets(name), nets):
+            for e in d:
+                p.stdin.write(f"{op} {c} {e}{x}\n")
+        p.stdin.close()
+    except BrokenPipeError:
+        pass
+    err = p.stderr.read()
+    if p.wait() != 0:
+        raise ufwc.UFWError(f"ipset restore: {err.strip()}")
+
+
+# name -> number of entries over both ip versions
+def block_list():
+    x = {}
+    name = None
+    for c in block_ipset("list", "-t").splitlines():
+        if c.startswith("Name: "):
+            name = c[6:].strip()
+        elif c.startswith("Number of entries: ") and name:
+            if name.startswith(("fwbot-", "fwbot6-")):
+                y = name.split("-", 1)[1]
+                x[y] = x.get(y, 0) + int(c.split(":")[1])
+    return x
+
+
+def block(command, replies):
+    """."""
+    if not verify(command.message):
+        return
+    ses = session(command)
+    ses.state = "menu"
+    pl = command.payload.split()
+    b = fw()[1]
+    alrt = ""
+    try:
+        if len(pl) >= 2 and not bpat.match(pl[1]):
+            alrt = "⚠️ names are up to 20 letters, digits or _"
+        elif len(pl) >= 3 and pl[0] == "add":
+            nets, bad = block_nets(pl[2:])
+            if bad:
+                alrt = "⚠️ arguments must be addresses or networks"
+            else:
+                block_create(b, pl[1])
+                block_restore("add", pl[1], nets)
+                block_save(b)
+                alrt = f"🔸 {sum(map(len, nets))} entries added to {pl[1]}"
+        elif len(pl) == 2 and pl[0] == "del":
+            block_destroy(b, pl[1])
+            block_save(b)
+            alrt = f"🔸 blocklist {pl[1]} removed"
+        elif len(pl) >= 3 and pl[0] == "del":
+            nets, bad = block_nets(pl[2:])
+            if bad:
+                alrt = "⚠️ arguments must be addresses or networks"
+            else:
+                block_restore("del", pl[1], nets)
+                block_save(b)
+                alrt = f"🔸 {sum(map(len, nets))} entries removed from {pl[1]}"
+        elif len(pl) == 3 and pl[0] == "import":
+            nets, bad = block_nets(block_tokens(pl[2]))
+            block_create(b, pl[1])
+            block_restore("add", pl[1], nets)
+            block_save(b)
+            alrt = f"🔸 {sum(map(len, nets))} entries imported to {pl[1]}, {bad} invalid skipped"
+        elif len(pl) == 2 and pl[0] == "list":
+            x = []
+            for c in block_sets(pl[1]):
+                y = block_ipset("list", c).split("Members:", 1)
+                x += [d for d in y[-1].splitlines() if d.strip()] if len(y) > 1 else []
+            y = "\n".join([f"🔹 '{c}'" for c in x[:50]])
+            if len(x) > 50:
+                y += f"\n🔸 ... and {len(x) - 50} more"
+            replies.add(f"🌐 BLOCKLIST {pl[1]}\n{y or '🔸 empty'}")
+            return
+        elif pl and not (len(pl) == 1 and pl[0] == "list"):
+            alrt = "⚠️ unknown or incomplete subcommand"
+    except (OSError, ufwc.UFWError) as xcp:
+        alrt = f"⛔️ ufw exception: {xcp}"
+    if alrt:
+        alrt = f"{alrt}\n\n"
+    try:
+        x = block_list()
+        x = "\n".join([f"🔹 {c}:  '{d} entries'" for c, d in sorted(x.items())]) or "🔸 no blocklists"
+    except ufwc.UFWError as xcp:
+        x = f"⛔️ ufw exception: {xcp}"
     replies.add(
-        f"🌐 SYSTEM\n🔹 Hostname:  '{host}'\n🔹 IP-address:  '{ip}'\n🔹 fwbot version:  '{version}'\n🔹 OS:  '{lin}'"
+        f"{alrt}🌐 BLOCKLISTS\n{x}\n\n🔺 /block  add  *name*  *address(es)*\nBlocks incoming traffic from addresses or networks, creates the list if needed.\n\n🔺 /block  del  *name*  [*address(es)*]\nRemoves addresses or the whole list.\n\n🔺 /block  import  *name*  *file*\nAdds all addresses of a local file, duplicates and neighbours are merged.\n\n🔺 /block  list  [*name*]\nShows the lists or the entries of one."
     )
 
 
-# >>> STATUS
+# >>> LOGS
+
+
+class Tail:
+    """Hands out what was appended to a log file since the last poll.
+
+    The position is kept as inode:offset in the bot's settings. After a
+    rotation the rest of the old file, now path.1, is read first. Without a
+    saved position reading starts at the end of the file.
+    """
+
+    def __init__(self, key, *paths):
+        self.key = key
+        self.paths = paths
+        self.ino = None
+        self.off = 0
+        self.rest = b""
+        self.saved = None
+
+    def start(self, path, st):
+        self.ino, self.off = st.st_ino, st.st_size
+        with suppress(ValueError, AttributeError):
+            x, y = [int(c) for c in dbot.get(f"tail_{self.key}").split(":")]
+            with suppress(OSError):
+                if x == st.st_ino or x == os.stat(f"{path}.1").st_ino:
+                    self.ino, self.off = x, y
+        self.saved = (self.ino, self.off)
+
+    # complete lines only, in chunks of about 1 MiB
+    def poll(self):
+        path = next((c for c in self.paths if os.path.exists(c)), None)
+        if path is None:
+            return
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        if self.ino is None:
+            self.start(path, st)
+        x = []
+        if st.st_ino != self.ino or st.st_size < self.off:
+            with suppress(OSError):
+                if os.stat(f"{path}.1").st_ino == self.ino:
+                    x.append((f"{path}.1", self.off))
+            self.ino, self.off = st.st_ino, 0
+        x.append((path, self.off))
+        for c, off in x:
+            with suppress(OSError), open(c, "rb") as f:
+                f.seek(off)
+                while True:
+                    y = f.read(1 << 20)
+                    if not y:
+                        break
+                    if c == path:
+                        self.off += len(y)
+                    y = self.rest + y
+                    i = y.rfind(b"\n") + 1
+                    self.rest = y[i:]
+                    if i:
+                        yield y[:i]
+
+    def save(self):
+        if (self.ino, self.off) != self.saved and self.ino is not None:
+            dbot.set(f"tail_{self.key}", f"{self.ino}:{self.off}")
+            self.saved = (self.ino, self.off)
+
+
+class TopK:
+    """Counts of at most k items, the smallest are dropped after each batch.
+
+    A batch only brings in its own 4k biggest items, so a flood of distinct
+    items costs the same as a few.
+    """
+
+    __slots__ = ("k", "counts")
+
+    def __init__(self, k=64):
+        self.k = k
+        self.counts = {}
+
+    def update(self, batch):
+        x = self.counts
+        for c, d in batch.most_common(4 * self.k):
+            x[c] = x.get(c, 0) + d
+        if len(x) > self.k:
+            self.counts = dict(heapq.nlargest(self.k, x.items(), key=lambda c: c[1]))
 
 
-def status(command, replies):
-    """."""
-    if not verify(command.message):
-        return
-    clear_cmd()
-    x = "active"
-    for c in ("input", "output"):
-        if ufwu.cmd([fw()[1].iptables, "-L", "ufw-user-%s" % (c), "-n"])[0] == 1:
-            x = "inactive"
-    if x == "active":
-        dbot.commands.register(name="/stop", func=status_stop)
-        replies.add(f"🌐 STATUS\n🔹 firewall:  'active'\n\n🔺 /stop\nStopps firewall and disables startup on boot.")
-    else:
-        dbot.commands.register(name="/start", func=status_start)
-        replies.add(f"🌐 STATUS\n🔹 firewall:  'inactive'\n\n🔺 /start\nStarts firewall and enables startup on boot.")
+# one match per blocked packet over a whole chunk
+bpkt = re.compile(
+    rb"\[UFW BLOCK\][^\n]*? SRC=([^ \n]+)[^\n]*? PROTO=([^ \n]+)(?: SPT=\d+ DPT=(\d+))?"
+)
 
 
-def status_start(command, replies):
-    """."""
-    if not verify(command.message):
-        return
-    clear_cmd()
-    fw()[0].set_enabled(True)
-    status(command, replies)
+class Blocked:
+    """Blocked packets by source, destination port and protocol.
 
+    There is a slot per minute for the last hour and per hour for the last
+    day, each with a total and a TopK per field, so memory stays the same
+    however much is logged.
+    """
 
-def status_stop(command, replies):
-    """."""
-    if not verify(command.message):
-        return
-    clear_cmd()
-    fw()[0].set_enabled(False)
-    status(command, replies)
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rings = ([None] * 60, [None] * 24)
+
+    def feed(self, chunk):
+        x = bpkt.findall(chunk)
+        if not x:
+            return
+        n = len(x)
+        x = [Counter(c) for c in zip(*x)]
+        x = (x[0], x[2], x[1])
+        x[1].pop(b"", None)
+        t = int(time.time() // 60)
+        with self.lock:
+            for ring, i in zip(self.rings, (t, t // 60)):
+                y = ring[i % len(ring)]
+                if y is None or y[0] != i:
+                    y = ring[i % len(ring)] = [i, 0, TopK(), TopK(), TopK()]
+                y[1] += n
+                for c, d in zip(y[2:], x):
+                    c.update(d)
+
+    # total and merged top items per field over the last minutes
+    def report(self, minutes):
+        t = int(time.time() // 60)
+        ring, lo = self.rings[0], t - minutes
+        if minutes > 60:
+            ring, lo, t = self.rings[1], t // 60 - minutes // 60, t // 60
+        x = [0, Counter(), Counter(), Counter()]
+        with self.lock:
+            for y in ring:
+                if y is not None and lo < y[0] <= t:
+                    x[0] += y[1]
+                    for c, d in zip(x[1:], y[2:]):
+                        c.update(d.counts)
+        return x
+
+
+class LogWatch:
+    """One thread polling the tails and feeding their chunks to consumers."""
+
+    def __init__(self, every=2.0):
+        self.every = every
+        self.tails = {}
+
+    def add(self, tail, func):
+        self.tails.setdefault(tail.key, (tail, []))[1].append(func)
+
+    def start(self):
+        threading.Thread(target=self.run, name="fwbot-logs", daemon=True).start()
+
+    def run(self):
+        n = 0
+        while True:
+            for tail, funcs in self.tails.values():
+                try:
+                    for c in tail.poll():
+                        for f in funcs:
+                            f(c)
+                    if n % 15 == 0:
+                        tail.save()
+                except Exception as xcp:
+                    dbot.logger.exception(xcp)
+            n += 1
+            time.sleep(self.every)
 
 
-# >>> POLICY
+blocked_log = Blocked()
+ufwlog = Tail("ufw", "/var/log/ufw.log", "/var/log/kern.log")
+logwatch = LogWatch()
+logwatch.add(ufwlog, blocked_log.feed)
+bwin = {"5m": 5, "1h": 60, "24h": 1440}
 
 
-def policy(command, replies):
+def blocked(command, replies):
     """."""
     if not verify(command.message):
         return
-    clear_cmd()
-    alrt = ""
-    if alert:
-        alrt = f"{alert[0]}\n\n"
-        alert.clear()
-    x = (fw()[1]._get_default_policy(), fw()[1]._get_default_policy("output"))
-    dbot.commands.register(name="//", func=policy_set)
-    replies.add(
-        f"{alrt}🌐 POLICIES\n🔹 incoming:  '{x[0]}'\n🔹 outgoing:  '{x[1]}'\n\n🔺 //  *action*  *action*\nSet the default action for incoming (1st) and outgoing (2nd) traffic to allow, deny or reject."
-    )
+    ses = session(command)
+    ses.state = "menu"
+    pl = command.payload.split()
+    w = pl[0] if pl else "1h"
+    if w not in bwin:
+        replies.add("⚠️ window must be 5m, 1h or 24h")
+        return
+    x = blocked_log.report(bwin[w])
+    y = [f"🌐 BLOCKED\n🔹 window:  '{w}'\n🔹 packets:  '{x[0]}'"]
+    if not x[0]:
+        y.append("🔸 nothing blocked")
+    for c, d in zip(("sources", "ports", "protocols"), x[1:]):
+        if d:
+            e = "\n".join([f"🔹 {k.decode()}:  '{v}'" for k, v in d.most_common(10)])
+            y.append(f"🔸 {c}\n{e}")
+    y.append("🔺 /blocked  [5m|1h|24h]\nTop sources, ports and protocols of blocked packets.")
+    replies.add("\n\n".join(y))
 
 
-def policy_set(command, replies):
-    """."""
-    if not verify(command.message):
-        return
-    clear_cmd()
-    pl = [c for c in command.payload.split() if c.strip()]
-    if len(pl) != 2:
-        alert.append("⚠️ expects two arguments")
-    elif not set(pl).issubset({"reject", "allow", "deny"}):
-        alert.append("⚠️ arguments must be reject, allow or deny")
-    else:
-        for c, d in zip(("incoming", "outgoing"), pl):
-            fw()[1].set_default_policy(d, c)
-        if fw()[1].is_enabled():
-            fw()[1].stop_firewall()
-            fw()[1].start_firewall()
-    policy(command, replies)
+# >>> AUTOBAN
 
+# failed ssh logins, the blocked packets come from bpkt
+apat = re.compile(rb"sshd\[\d+\]: Failed \S+ for (?:invalid user )?\S+ from ([0-9a-fA-F:.]+)")
+upat = re.compile(rb"\[UFW BLOCK\][^\n]*? SRC=([^ \n]+)")
 
-# >>> RULES
 
+class Autoban:
+    """Hits per source over a sliding window, sources over the threshold are
+    banned for a while through the autoban blocklist.
 
-def rules(command, replies):
+    A source has two counters, the current window and the one before that is
+    weighted by how much of it still overlaps, so an update is O(1). Sources
+    are kept in an LRU of at most size entries.
+    """
+
+    def __init__(self, size=65536):
+        self.size = size
+        self.on = False
+        self.limit = 20
+        self.window = 60
+        self.ban = 3600
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def load(self):
+        with suppress(ValueError, AttributeError):
+            x = dbot.get("autoban").split()
+            self.on = x[0] == "on"
+            self.limit, self.window, self.ban = [int(c) for c in x[1:4]]
+
+    def save(self):
+        dbot.set("autoban", f"{'on' if self.on else 'off'} {self.limit} {self.window} {self.ban}")
+
+    def feed(self, pat, chunk):
+        if not self.on:
+            return
+        x = pat.findall(chunk)
+        if not x:
+            return
+        now = time.time()
+        with self.lock:
+            for c, n in Counter(x).items():
+                self.hit(c.decode(), n, now)
+        if self.pending:
+            wq.put(partial(autoban_apply, self.pending))
+            self.pending = {}
+
+    def hit(self, src, n, now):
+        x = self.lru.pop(src, None)
+        if x is None:
+            # window start, current count, previous count, banned until
+            x = [now, 0, 0, 0.0]
+        w = self.window
+        if now - x[0] >= w:
+            k = int((now - x[0]) // w)
+            x[2] = x[1] if k == 1 else 0
+            x[1] = 0
+            x[0] += k * w
+        x[1] += n
+        self.lru[src] = x
+        if len(self.lru) > self.size:
+            self.lru.popitem(last=False)
+        if x[3] > now:
+            return
+        y = x[2] * (1 - (now - x[0]) / w) + x[1]
+        if y >= self.limit:
+            x[3] = now + self.ban
+            self.pending[src] = int(y)
+
+    def banned(self):
+        now = time.time()
+        with self.lock:
+            return sum([1 for c in self.lru.values() if c[3] > now])
+
+
+autoban = Autoban()
+authlog = Tail("auth", "/var/log/auth.log", "/var/log/secure")
+logwatch.add(ufwlog, partial(autoban.feed, upat))
+logwatch.add(authlog, partial(autoban.feed, apat))
+
+
+# runs on the mutation worker, one ipset restore and one message per batch
+def autoban_apply(hits):
+    own = facts.interfaces()
+    x = {}
+    for c, d in hits.items():
+        with suppress(ValueError):
+            y = ipaddress.ip_address(c)
+            if not (y.is_loopback or y.is_unspecified or y in own):
+                x[y] = d
+    if not x:
+        return
+    b = fw()[1]
+    try:
+        block_create(b, "autoban", True)
+        block_restore(
+            "add",
+            "autoban",
+            ([c for c in x if c.version == 4], [c for c in x if c.version == 6]),
+            autoban.ban,
+        )
+        block_save(b)
+    except (OSError, ufwc.UFWError) as xcp:
+        admins(f"⛔️ ufw exception: {xcp}\n{len(x)} sources were not banned")
+        return
+    y = sorted(x.items(), key=lambda c: -c[1])
+    z = "\n".join([f"🔹 {c}:  '{d} hits'" for c, d in y[:20]])
+    if len(y) > 20:
+        z += f"\n🔸 ... and {len(y) - 20} more"
+    admins(f"🚫 AUTOBAN\n{len(y)} sources banned for {ttl_fmt(autoban.ban)}\n{z}")
+
+
+def autoban_cmd(command, replies):
     """."""
     if not verify(command.message):
         return
-    clear_cmd()
+    ses = session(command)
+    ses.state = "menu"
+    pl = command.payload.split()
     alrt = ""
-    if alert:
-        alrt = f"{alert[0]}\n\n"
-        alert.clear()
-    x = []
-    for c in fw()[1].get_rules():
-        x.append(f"🔹 {len(x) + 1}:  '{ufwp.UFWCommandRule.get_command(c)}'")
-    dbot.commands.register(name="//", func=rules_pl)
-    y = ["\n\n", "", ""]
-    if len(x) > 0:
-        dbot.commands.register(name="/del", func=rules_del)
-        y[2] = "\n🔺 /del  *rulenumber*\nDelete a rule.\n"
-    if len(x) > 1:
-        dbot.commands.register(name="/reset", func=rules_rst)
-        y[0] = "\n🔺 /reset\nDelete all rules shown above.\n"
-        dbot.commands.register(name="/move", func=rules_mv)
-        y[
-            1
-        ] = "\n🔺 /move  *rulenumber*  *position*\nMoves an existing rule to a specific position. (experimental)\n"
-    x = "\n".join(x)
+    if pl and pl[0] in ("on", "off") and len(pl) == 1:
+        autoban.on = pl[0] == "on"
+        autoban.save()
+    elif len(pl) == 2 and pl[0] == "threshold" and pl[1].isnumeric() and int(pl[1]) > 0:
+        autoban.limit = int(pl[1])
+        autoban.save()
+    elif len(pl) == 2 and pl[0] in ("window", "ban") and dur_secs(pl[1]):
+        if pl[0] == "window":
+            autoban.window = dur_secs(pl[1])
+        else:
+            autoban.ban = dur_secs(pl[1])
+        autoban.save()
+    elif pl:
+        alrt = "⚠️ invalid argument(s)\n\n"
+    a = autoban
     replies.add(
-        f"{alrt}🌐 RULES\n{x}\n\n🔺 //  *ufw-command*\nSpecify a valid ufw-command to add or insert allow/deny/reject/limit-rules or to delete rules.\n{y[2]}{y[0]}{y[1]}\n📖 rule syntax: https://is.gd/18ivdz"
+        f"{alrt}🌐 AUTOBAN\n🔹 autoban:  '{'on' if a.on else 'off'}'\n🔹 threshold:  '{a.limit} hits'\n🔹 window:  '{ttl_fmt(a.window)}'\n🔹 ban:  '{ttl_fmt(a.ban)}'\n🔹 tracked:  '{len(a.lru)} sources'\n🔹 banned:  '{a.banned()} sources'\n\n🔺 /autoban  on|off\nBans sources with blocked packets or failed ssh logins over the threshold.\n\n🔺 /autoban  threshold  *hits*\n🔺 /autoban  window  *duration*\n🔺 /autoban  ban  *duration*\nSet the hits within the window (e.g. 60s) that lead to a ban and how long it lasts (e.g. 1h)."
     )
 
 
-# maybe add check for proto any and port any and remove them as they will raise an ufw ERROR because of a long time unfixed bug
-def rules_pl(command, replies):
-    """."""
-    if not verify(command.message):
-        return
-    opt = ("allow", "deny", "reject", "limit", "delete", "insert")
-    clear_cmd()
-    p = ufwp.UFWParser()
-    for c in opt:
-        p.register_command(ufwp.UFWCommandRule(c))
-    if "comment" in command.payload:
-        plx = re.split("comment", command.payload)
-        pl = [c for c in plx[0].split() if c.strip()]
-        cmt = [c for c in plx[1].split() if c.strip()]
-    else:
-        pl = [c for c in command.payload.split() if c.strip()]
-        cmt = []
-    if len(pl) < 2:
-        alert.append("⚠️ expects arguments")
-    elif pl[0] not in opt:
-        alert.append("⚠️ invalid *action*")
-    # add elif for insert but invalid action - length of pl has to be checked
-    else:
-        if cmt:
-            pl.append("comment")
-            pl.append(" ".join(cmt))
-        try:
-            pr = p.parse_command(pl)
-            print(pr)
-            fw()[0].do_action(
-                pr.action, pr.data.get("rule", ""), pr.data.get("iptype", ""), True
-            )
-        except Exception as xcp:
-            alert.append(f"⛔️ ufw exception: {xcp}")
-        except:
-            alert.append(f"📛 ufw error")
-    rules(command, replies)
+# >>> SOCKETS
 
+# listening tcp and unconnected udp sockets, like netstat -lnp
+sstates = {"tcp": ("0A", 1 << 10), "udp": ("07", 1 << 7)}
+# inode -> (pid, fd, exe) of the listeners seen by the previous call
+scache = {"sock": {}, "diag": True}
 
-def rules_del(command, replies):
-    """."""
-    if not verify(command.message):
-        return
-    clear_cmd()
-    p = ufwp.UFWParser()
-    p.register_command(ufwp.UFWCommandRule("delete"))
-    pl = [c for c in command.payload.split() if c.strip()]
-    if len(pl) != 1:
-        alert.append("⚠️ expects one argument")
-    elif not pl[0].isnumeric():
-        alert.append("⚠️ argument must be numeric")
-    elif not 0 < int(pl[0]) <= fw()[1].get_rules_count(False):
-        alert.append("⚠️ argument must be valid rulenumber")
-    else:
-        try:
-            pr = p.parse_command(["delete", pl[0]])
-            fw()[0].do_action(
-                pr.action, pr.data.get("rule", ""), pr.data.get("iptype", ""), True
-            )
-        except Exception as xcp:
-            alert.append(f"⛔️ ufw exception: {xcp}")
-        except:
-            alert.append(f"📛 ufw error")
-    rules(command, replies)
 
+def proc_addr(x):
+    b = bytes.fromhex(x)
+    if len(b) == 4:
+        return socket.inet_ntop(socket.AF_INET, b[::-1])
+    b = b"".join([b[i : i + 4][::-1] for i in range(0, 16, 4)])
+    return socket.inet_ntop(socket.AF_INET6, b)
 
-def rules_rst(command, replies):
-    """."""
-    if not verify(command.message):
-        return
-    clear_cmd()
-    p = ufwp.UFWParser()
-    p.register_command(ufwp.UFWCommandRule("delete"))
-    while fw()[1].get_rules_count(False) > 0:
-        try:
-            pr = p.parse_command(["delete", "1"])
-            fw()[0].do_action(
-                pr.action, pr.data.get("rule", ""), pr.data.get("iptype", ""), True
-            )
-        except Exception as xcp:
-            alert.append(f"⛔️ ufw exception: {xcp}")
-        except:
-            alert.append(f"📛 ufw error")
-    rules(command, replies)
 
+# one bulk read per file, filtered on the state column before anything else
+def proc_sockets(proto):
+    x = []
+    st = sstates[proto[:3]][0]
+    with open(f"/proc/net/{proto}", "rb", buffering=0) as f:
+        data = f.read().decode("ascii", "replace")
+    for c in data.splitlines()[1:]:
+        y = c.split()
+        if len(y) < 10 or y[3] != st:
+            continue
+        a, _, p = y[1].partition(":")
+        x.append((proto, proc_addr(a), int(p, 16), y[7], y[9]))
+    return x
+
+
+# NETLINK_SOCK_DIAG dump, the kernel filters by state for us
+def diag_sockets(proto):
+    fam = socket.AF_INET6 if proto.endswith("6") else socket.AF_INET
+    ipp = socket.IPPROTO_TCP if proto.startswith("tcp") else socket.IPPROTO_UDP
+    req = struct.pack("=BBBBI", fam, ipp, 0, 0, sstates[proto[:3]][1]) + bytes(48)
+    # nlmsghdr: SOCK_DIAG_BY_FAMILY, NLM_F_REQUEST | NLM_F_DUMP
+    req = struct.pack("=IHHII", 16 + len(req), 20, 0x301, 1, 0) + req
+    x = []
+    with socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, 4) as s:
+        s.settimeout(2)
+        s.send(req)
+        while True:
+            data = s.recv(1 << 16)
+            i = 0
+            while i + 16 <= len(data):
+                ln, typ = struct.unpack_from("=IH", data, i)
+                if typ == 3:
+                    return x
+                if typ == 2 or ln < 16:
+                    raise OSError("sock_diag failed")
+                m = i + 16
+                port = struct.unpack_from("!H", data, m + 4)[0]
+                a = data[m + 8 : m + 24]
+                if fam == socket.AF_INET:
+                    a = socket.inet_ntop(fam, a[:4])
+                else:
+                    a = socket.inet_ntop(fam, a)
+                uid, inode = struct.unpack_from("=II", data, m + 64)
+                x.append((proto, a, port, str(uid), str(inode)))
+                i += (ln + 3) & ~3
 
-# move muss überarbeitet werden, ggf. statt position angeben, ob vor oder hinter einer bestimmten rule
-def rules_mv(command, replies):
-    """."""
-    if not verify(command.message):
-        return
-    clear_cmd()
-    p = ufwp.UFWParser()
-    for c in ("delete", "insert"):
-        p.register_command(ufwp.UFWCommandRule(c))
-    pl = [c for c in command.payload.split() if c.strip()]
-    if len(pl) != 2:
-        alert.append("⚠️ expects two arguments")
-    elif not all([c.isnumeric() for c in pl]):
-        alert.append("⚠️ arguments must be numeric")
-    else:
-        x = fw()[1].get_rules_count(False)
-        y = int(pl[0])
-        z = int(pl[1])
-        if not (y != z and 0 < y <= x and 0 < z <= x):
-            # could be more elaborate
-            alert.append("⚠️ invalid argument(s)")
-        else:
-            rle = ufwp.UFWCommandRule.get_command(fw()[1].get_rules()[y - 1]).split()
+
+def proc_exe(pid):
+    try:
+        return os.path.basename(os.readlink(f"/proc/{pid}/exe"))
+    except OSError:
+        return "-"
+
+
+# inode -> (pid, fd, exe), the previous owners are checked with one readlink
+# each, /proc/*/fd is only walked for the rest and only until all are found
+def proc_owners(inodes):
+    x = {}
+    want = set(inodes)
+    for i in list(want):
+        c = scache["sock"].get(i)
+        if c is None:
+            continue
+        with suppress(OSError):
+            if os.readlink(f"/proc/{c[0]}/fd/{c[1]}") == f"socket:[{i}]":
+                x[i] = c
+                want.discard(i)
+    if want:
+        for pid in os.listdir("/proc"):
+            if not pid.isdigit():
+                continue
             try:
-                pr = p.parse_command(["delete"] + rle)
-                fw()[0].do_action(
-                    pr.action,
-                    pr.data.get("rule", ""),
-                    pr.data.get("iptype", ""),
-                    True,
-                )
-            except Exception as xcp:
-                alert.append(f"⛔️ ufw exception: {xcp}")
-            except:
-                alert.append(f"📛 ufw error")
-            else:
-                w = 0
-                if y < z:
-                    w = 1
+                fds = os.listdir(f"/proc/{pid}/fd")
+            except OSError:
+                continue
+            exe = None
+            for fd in fds:
                 try:
-                    pr = p.parse_command(["insert"] + [str(z - w)] + rle)
-                    fw()[0].do_action(
-                        pr.action,
-                        pr.data.get("rule", ""),
-                        pr.data.get("iptype", ""),
-                        True,
-                    )
-                except Exception as xcp:
-                    alert.append(f"⛔️ ufw exception: {xcp}")
-                except:
-                    alert.append(f"📛 ufw error")
-    rules(command, replies)
+                    y = os.readlink(f"/proc/{pid}/fd/{fd}")
+                except OSError:
+                    continue
+                if y.startswith("socket:[") and y[8:-1] in want:
+                    if exe is None:
+                        exe = proc_exe(pid)
+                    x[y[8:-1]] = (pid, fd, exe)
+                    want.discard(y[8:-1])
+            if not want:
+                break
+    scache["sock"] = x
+    return x
+
+
+def listen_sockets(v6):
+    x = []
+    for c in ("tcp", "udp", "tcp6", "udp6"):
+        if c.endswith("6") and not v6:
+            continue
+        if scache["diag"]:
+            try:
+                x.extend(diag_sockets(c))
+                continue
+            except OSError:
+                scache["diag"] = False
+        with suppress(OSError):
+            x.extend(proc_sockets(c))
+    return x
+
+
+# same structure as ufw.util.parse_netstat_output()
+def listeners(v6):
+    socks = listen_sockets(v6)
+    owners = proc_owners([c[4] for c in socks if c[4] != "0"])
+    d = {}
+    for proto, addr, port, uid, inode in socks:
+        pid, _, exe = owners.get(inode, ("-", None, "-"))
+        d.setdefault(proto, {}).setdefault(str(port), []).append(
+            {"laddr": addr, "uid": uid, "pid": pid, "exe": exe}
+        )
+    return d
 
 
 # >>> SERVICE
-serv = []
-dels = []
 
 
 def service(command, replies):
     """."""
     if not verify(command.message):
         return
-    clear_cmd()
+    ses = session(command)
     alrt = ""
-    if alert:
-        alrt = f"{alert[0]}\n\n"
-        alert.clear()
+    if ses.alert:
+        alrt = f"{ses.alert[0]}\n\n"
+        ses.alert.clear()
+    b = fw()[1]
     try:
-        netstat = ufwu.parse_netstat_output(fw()[1].use_ipv6())
-    except Exception:
+        netstat = listeners(b.use_ipv6())
+    except OSError as xcp:
+        dbot.logger.exception(xcp)
+        ses.state = "menu"
+        replies.add(f"{alrt}⛔️ ufw exception: {xcp}")
         return
-    listeners = []
-    rules = fw()[1].get_rules()
+    found = []
+    rules = ruleset().recs
+    idx = MatchIndex(rules)
     l4_protocols = list(netstat.keys())
     l4_protocols.sort()
     for transport in l4_protocols:
-        if not fw()[1].use_ipv6() and transport in ["tcp6", "udp6"]:
+        if not b.use_ipv6() and transport in ["tcp6", "udp6"]:
             continue
         ports = list(netstat[transport].keys())
         ports.sort()
@@ -430,7 +3057,7 @@ def service(command, replies):
                     listen_addr = "%s/0" % (item["laddr"])
                     addr = "*"
                 else:
-                    ifname = ufwu.get_if_from_ip(listen_addr)
+                    ifname = facts.iface(listen_addr)
                     addr = listen_addr
                 application = os.path.basename(item["exe"])
                 rule = ufwc.UFWRule(
@@ -446,22 +3073,20 @@ def service(command, replies):
                     rule.set_interface("in", ifname)
                 rule.normalize()
                 matching_rules = {}
-                matching = fw()[1].get_matching(rule)
+                matching = idx.match(rule)
                 if len(matching) > 0:
                     for rule_number in matching:
                         if rule_number > 0 and rule_number - 1 < len(rules):
-                            rule = fw()[1].get_rule_by_number(rule_number)
-                            rule_command = ufwp.UFWCommandRule.get_command(rule)
-                            matching_rules[rule_number] = rule_command
-                listeners.append(
+                            matching_rules[rule_number] = rules[rule_number - 1].cmd
+                found.append(
                     (transport, addr, int(port), application, matching_rules)
                 )
     x = []
-    serv.clear()
-    dels.clear()
+    ses.serv.clear()
+    ses.dels.clear()
     i = 0
     rl = False
-    for c in listeners:
+    for c in found:
         z = c[1]
         if z == "*":
             z = "all"
@@ -469,26 +3094,26 @@ def service(command, replies):
         if c[4]:
             y = []
             for k, v in c[4].items():
-                dels.append(k)
+                ses.dels.append(k)
                 y.append(f"\t\t🔹 {k}:  '{v}'")
             y = "\n" + "\n".join(y)
             rl = True
-        serv.append((c[0], c[1], c[2], c[3]))
+        ses.serv.append((c[0], c[1], c[2], c[3]))
         x.append(
             f"🔷 ID: {i}\n\t🔹 Service:  '{c[3]}'\n\t🔹 Protocol:  '{c[0]}'\n\t🔹 Port:  '{c[2]}'\n\t🔹 Address:  '{z}'\n\t🔹 Rules:  {y}"
         )
         i += 1
     if x:
-        dbot.commands.register(name="//", func=service_pl)
+        ses.state = "service"
         y = "\n\n"
         if rl:
-            dbot.commands.register(name="/del", func=service_del)
             y = "\n🔺 /del  *rulenumber* \nDelete a corresponding rule.\n"
         x = "\n".join(x)
         replies.add(
             f"{alrt}🌐 SERVICES\n{x}\n\n🔺 //  *action*  *ID*\nAutomagically create a corresponding rule with action allow, deny or reject. This rule will match the service as closely as possible.\n{y}\nDepending on your default profile or before rules it might not be necessary to have explicit rules for every listener."
         )
     else:
+        ses.state = "menu"
         replies.add(f"{alrt}🌐 SERVICES\n\nNo listening services found.")
 
 
@@ -496,44 +3121,40 @@ def service_pl(command, replies):
     """."""
     if not verify(command.message):
         return
-    clear_cmd()
+    ses = session(command)
+    ses.state = "menu"
     pl = [c for c in command.payload.split() if c.strip()]
     if len(pl) != 2:
-        alert.append("⚠️ expects two arguments")
+        ses.alert.append("⚠️ expects two arguments")
     elif pl[0] not in ("allow", "deny", "reject"):
-        alert.append("⚠️ 1st argument must be allow, deny or reject")
+        ses.alert.append("⚠️ 1st argument must be allow, deny or reject")
     elif not pl[1].isnumeric():
-        alert.append("⚠️ 2nd argument must be numeric")
-    elif not 0 <= int(pl[1]) < len(serv):
-        alert.append("⚠️ 2nd argument must be valid ID")
+        ses.alert.append("⚠️ 2nd argument must be numeric")
+    elif not 0 <= int(pl[1]) < len(ses.serv):
+        ses.alert.append("⚠️ 2nd argument must be valid ID")
     else:
         p = ufwp.UFWParser()
         p.register_command(ufwp.UFWCommandRule(pl[0]))
-        ppll = [pl[0], f"{serv[int(pl[1])][2]}/{serv[int(pl[1])][0]}"]
-        if serv[int(pl[1])][1] != "*":
+        ppll = [pl[0], f"{ses.serv[int(pl[1])][2]}/{ses.serv[int(pl[1])][0]}"]
+        if ses.serv[int(pl[1])][1] != "*":
             ppll = [
                 pl[0],
                 "to",
-                serv[int(pl[1])][1],
+                ses.serv[int(pl[1])][1],
                 "port",
-                str(serv[int(pl[1])][2]),
+                str(ses.serv[int(pl[1])][2]),
                 "proto",
-                serv[int(pl[1])][0],
+                ses.serv[int(pl[1])][0],
             ]
         ppll.append("comment")
-        ppll.append(f"auto for {serv[int(pl[1])][3]}")
+        ppll.append(f"auto for {ses.serv[int(pl[1])][3]}")
         try:
             pr = p.parse_command(ppll)
-            fw()[0].do_action(
-                pr.action,
-                pr.data.get("rule", ""),
-                pr.data.get("iptype", ""),
-                True,
-            )
+            fw_do(pr)
         except Exception as xcp:
-            alert.append(f"⛔️ ufw exception: {xcp}")
+            ses.alert.append(f"⛔️ ufw exception: {xcp}")
         except:
-            alert.append(f"📛 ufw error")
+            ses.alert.append("📛 ufw error")
     service(command, replies)
 
 
@@ -541,54 +3162,46 @@ def service_del(command, replies):
     """."""
     if not verify(command.message):
         return
-    clear_cmd()
+    ses = session(command)
+    ses.state = "menu"
     pl = [c for c in command.payload.split() if c.strip()]
     if len(pl) != 1:
-        alert.append("⚠️ expects one argument")
+        ses.alert.append("⚠️ expects one argument")
     elif not pl[0].isnumeric():
-        alert.append("⚠️ argument must be numeric")
-    elif int(pl[0]) not in dels:
-        alert.append("⚠️ argument must be valid rulenumber")
+        ses.alert.append("⚠️ argument must be numeric")
+    elif int(pl[0]) not in ses.dels:
+        ses.alert.append("⚠️ argument must be valid rulenumber")
     else:
         p = ufwp.UFWParser()
         p.register_command(ufwp.UFWCommandRule("delete"))
         try:
             pr = p.parse_command(["delete", pl[0]])
-            fw()[0].do_action(
-                pr.action, pr.data.get("rule", ""), pr.data.get("iptype", ""), True
-            )
+            fw_do(pr)
         except Exception as xcp:
-            alert.append(f"⛔️ ufw exception: {xcp}")
+            ses.alert.append(f"⛔️ ufw exception: {xcp}")
         except:
-            alert.append(f"📛 ufw error")
+            ses.alert.append("📛 ufw error")
     service(command, replies)
 
 
 # >>> GUIDE
 gmd = ["append", "incoming", None, "any", "any", "tcp/udp", "any", None]
-gmc = []
-
-
-def guide_unreg(x=None):
-    for c in (x, "b", "s", "/", "f", "d", "out", "src", "dst"):
-        with suppress(Exception):
-            dbot.commands.unregister(name=f"/{c}")
 
 
 def guide_q(command, replies):
     """."""
     if not verify(command.message):
         return
-    gmc.clear()
-    guide_unreg("q")
-    menu()
+    ses = session(command)
+    ses.gmc.clear()
+    ses.state = "menu"
     replies.add("⚠️ guided mode cancelled")
 
 
-def guide_r(i):
+def guide_r(ses, i):
     z = "Position Direction Action Source Destination Protocol Port(range)s Comment"
     x = []
-    for c, d, e in zip(range(8), z.split(), gmc):
+    for c, d, e in zip(range(8), z.split(), ses.gmc):
         y = "🔹 "
         if c == i and c < 8:
             y = "🔸 "
@@ -600,18 +3213,13 @@ def guide(command, replies):
     """."""
     if not verify(command.message):
         return
+    ses = session(command)
     txt = "This mode will guide you through the creation of a firewall rule. Below you will find a list of rules as well as all possible commands.\nOnce started, you will be presented with the new rule and its default values and an indicator for which value is currently being edited.\nIf available, you may choose  /s  (skip)  to advance to the next step (maintaining the current value or default).\nIf available, you may choose  /d  (default)  to set a value to its default and advance to the next step.\n To (re-)edit a (skipped) setting, use  /b  (back)  to go to the previous step.\nTo exit this mode at any time, use  /q  (quit)  - all settings done so far will be discarded.\n\nEach step will explain what is being edited as well as possible commands and arguments.\n(in addition to  /d  /b  /s  /q)."
-    clear_cmd()
-    menu_off()
-    gmc.clear()
+    ses.gmc.clear()
     for c in gmd:
-        gmc.append(c)
-    dbot.commands.register(name="/q", func=guide_q)
-    dbot.commands.register(name="/s", func=guide_0)
-    x = []
-    for c in fw()[1].get_rules():
-        x.append(f"🔹 {len(x) + 1}:  '{ufwp.UFWCommandRule.get_command(c)}'")
-    x = "\n".join(x)
+        ses.gmc.append(c)
+    ses.state = "guide"
+    x = ruleset().listing
     replies.add(f"🌐 GUIDE\n{txt}\n\n🌐 RULES\n{x}\n\n🔺 /s  (start)\n🔺 /q  (quit)")
 
 
@@ -619,10 +3227,11 @@ def guide_0(command, replies):
     """."""
     if not verify(command.message):
         return
+    ses = session(command)
     alrt = ""
-    if alert:
-        alrt = f"{alert[0]}\n\n"
-        alert.clear()
+    if ses.alert:
+        alrt = f"{ses.alert[0]}\n\n"
+        ses.alert.clear()
     x = fw()[1].get_rules_count(False)
     y = "Allowed values for *position*:  1"
     if x > 1:
@@ -630,19 +3239,15 @@ def guide_0(command, replies):
     elif x == 0:
         y = "No rules set, can only append!"
     txt = f"Do you want to insert this rule at a specific position or append it at the end of all rules?\n(Default: append)\nRules are evaluated from top to bottom!\n\n{y}"
-    guide_unreg()
-    dbot.commands.register(name="/s", func=guide_1)
-    #dbot.commands.register(name="//", func=guide_0_pl)
+    ses.state = "guide_0"
     d = ""
     z = ""
-    if gmc[0] != gmd[0]:
-        dbot.commands.register(name="/d", func=guide_0_def)
+    if ses.gmc[0] != gmd[0]:
         d = "\n🔺 /d  (default)"
     if x != 0:
-        dbot.commands.register(name="//", func=guide_0_pl)
         z = "\n🔺 //  *position*"
     replies.add(
-        f"{alrt}🌐 GUIDE (1/8)\n{txt}\n\n{guide_r(0)}\n{z}{d}\n🔺 /s  (skip)\n🔺 /q  (quit)"
+        f"{alrt}🌐 GUIDE (1/8)\n{txt}\n\n{guide_r(ses, 0)}\n{z}{d}\n🔺 /s  (skip)\n🔺 /q  (quit)"
     )
 
 
@@ -650,7 +3255,8 @@ def guide_0_def(command, replies):
     """."""
     if not verify(command.message):
         return
-    gmc[0] = gmd[0]
+    ses = session(command)
+    ses.gmc[0] = gmd[0]
     guide_1(command, replies)
 
 
@@ -658,15 +3264,16 @@ def guide_0_pl(command, replies):
     """."""
     if not verify(command.message):
         return
+    ses = session(command)
     pl = [c for c in command.payload.split() if c.strip()]
     if len(pl) != 1:
-        alert.append("⚠️ expects one argument")
+        ses.alert.append("⚠️ expects one argument")
     elif not pl[0].isnumeric():
-        alert.append("⚠️ argument must be numeric")
+        ses.alert.append("⚠️ argument must be numeric")
     elif not 0 < int(pl[0]) <= fw()[1].get_rules_count(False):
-        alert.append("⚠️ argument must be valid position")
+        ses.alert.append("⚠️ argument must be valid position")
     else:
-        gmc[0] = pl[0]
+        ses.gmc[0] = pl[0]
         guide_1(command, replies)
         return
     guide_0(command, replies)
@@ -676,18 +3283,15 @@ def guide_1(command, replies):
     """."""
     if not verify(command.message):
         return
+    ses = session(command)
     txt = "Do you want this rule to target traffic directed towards your system (incoming) or traffic originating from your system (outgoing)?\n(Default: incoming)\n\nDepending on the current setting, use  /out  or  /d  to switch between these options."
-    guide_unreg()
-    dbot.commands.register(name="/s", func=guide_2)
-    dbot.commands.register(name="/b", func=guide_0)
-    if gmc[1] == gmd[1]:
-        dbot.commands.register(name="/out", func=guide_1_out)
+    ses.state = "guide_1"
+    if ses.gmc[1] == gmd[1]:
         x = "\n🔺 /out"
     else:
-        dbot.commands.register(name="/d", func=guide_1_def)
         x = "\n🔺 /d  (default)"
     replies.add(
-        f"🌐 GUIDE (2/8)\n{txt}\n\n{guide_r(1)}\n{x}\n🔺 /b  (back)\n🔺 /s  (skip)\n🔺 /q  (quit)"
+        f"🌐 GUIDE (2/8)\n{txt}\n\n{guide_r(ses, 1)}\n{x}\n🔺 /b  (back)\n🔺 /s  (skip)\n🔺 /q  (quit)"
     )
 
 
@@ -695,7 +3299,8 @@ def guide_1_def(command, replies):
     """."""
     if not verify(command.message):
         return
-    gmc[1] = gmd[1]
+    ses = session(command)
+    ses.gmc[1] = gmd[1]
     guide_2(command, replies)
 
 
@@ -703,7 +3308,8 @@ def guide_1_out(command, replies):
     """."""
     if not verify(command.message):
         return
-    gmc[1] = "outgoing"
+    ses = session(command)
+    ses.gmc[1] = "outgoing"
     guide_2(command, replies)
 
 
@@ -711,20 +3317,18 @@ def guide_2(command, replies):
     """."""
     if not verify(command.message):
         return
+    ses = session(command)
     alrt = ""
-    if alert:
-        alrt = f"{alert[0]}\n\n"
-        alert.clear()
+    if ses.alert:
+        alrt = f"{ses.alert[0]}\n\n"
+        ses.alert.clear()
     txt = "Which action would you like the rule to take for the targeted traffic?\nThis setting has no default value.\n\nAllowed values for *action*:\n・ allow\n    (traffic will be accepted)\n・ deny\n    (traffic will be discarded)\n・ reject\n    (traffic will be discarded and an error paket will be returned to the sender)"
-    guide_unreg()
-    dbot.commands.register(name="/b", func=guide_1)
-    dbot.commands.register(name="//", func=guide_2_pl)
+    ses.state = "guide_2"
     s = ""
-    if gmc[2] != gmd[2]:
-        dbot.commands.register(name="/s", func=guide_3)
+    if ses.gmc[2] != gmd[2]:
         s = "\n🔺 /s  (skip)"
     replies.add(
-        f"{alrt}🌐 GUIDE (3/8)\n{txt}\n\n{guide_r(2)}\n\n🔺 //  *action*\n🔺 /b  (back){s}\n🔺 /q  (quit)"
+        f"{alrt}🌐 GUIDE (3/8)\n{txt}\n\n{guide_r(ses, 2)}\n\n🔺 //  *action*\n🔺 /b  (back){s}\n🔺 /q  (quit)"
     )
 
 
@@ -732,13 +3336,14 @@ def guide_2_pl(command, replies):
     """."""
     if not verify(command.message):
         return
+    ses = session(command)
     pl = [c for c in command.payload.split() if c.strip()]
     if len(pl) != 1:
-        alert.append("⚠️ expects one argument")
+        ses.alert.append("⚠️ expects one argument")
     elif pl[0] not in ("allow", "deny", "reject"):
-        alert.append("⚠️ argument must be allow, deny or reject")
+        ses.alert.append("⚠️ argument must be allow, deny or reject")
     else:
-        gmc[2] = pl[0]
+        ses.gmc[2] = pl[0]
         guide_3(command, replies)
         return
     guide_2(command, replies)
@@ -748,21 +3353,18 @@ def guide_3(command, replies):
     """."""
     if not verify(command.message):
         return
+    ses = session(command)
     alrt = ""
-    if alert:
-        alrt = f"{alert[0]}\n\n"
-        alert.clear()
+    if ses.alert:
+        alrt = f"{ses.alert[0]}\n\n"
+        ses.alert.clear()
     txt = "Do you want this rule to filter traffic originating from a specific source?\n(Default: any)\n\nAllowed values for *source*:\n・ host  (e.g. 8.8.8.8)\n・ network  (e.g. 8.8.8.8/24)"
-    guide_unreg()
-    dbot.commands.register(name="/b", func=guide_2)
-    dbot.commands.register(name="/s", func=guide_4)
-    dbot.commands.register(name="//", func=guide_3_pl)
+    ses.state = "guide_3"
     d = ""
-    if gmc[3] != gmd[3]:
-        dbot.commands.register(name="/d", func=guide_3_def)
+    if ses.gmc[3] != gmd[3]:
         d = "\n🔺 /d  (default)"
     replies.add(
-        f"{alrt}🌐 GUIDE (4/8)\n{txt}\n\n{guide_r(3)}\n\n🔺 //  *source*{d}\n🔺 /b  (back)\n🔺 /s  (skip)\n🔺 /q  (quit)"
+        f"{alrt}🌐 GUIDE (4/8)\n{txt}\n\n{guide_r(ses, 3)}\n\n🔺 //  *source*{d}\n🔺 /b  (back)\n🔺 /s  (skip)\n🔺 /q  (quit)"
     )
 
 
@@ -770,7 +3372,8 @@ def guide_3_def(command, replies):
     """."""
     if not verify(command.message):
         return
-    gmc[3] = gmd[3]
+    ses = session(command)
+    ses.gmc[3] = gmd[3]
     guide_4(command, replies)
 
 
@@ -778,13 +3381,14 @@ def guide_3_pl(command, replies):
     """."""
     if not verify(command.message):
         return
+    ses = session(command)
     pl = [c for c in command.payload.split() if c.strip()]
     if len(pl) != 1:
-        alert.append("⚠️ expects one argument")
+        ses.alert.append("⚠️ expects one argument")
     elif not ufwu.valid_address4(pl[0]):
-        alert.append("⚠️ argument must be host or network")
+        ses.alert.append("⚠️ argument must be host or network")
     else:
-        gmc[3] = pl[0]
+        ses.gmc[3] = pl[0]
         guide_4(command, replies)
         return
     guide_3(command, replies)
@@ -794,21 +3398,18 @@ def guide_4(command, replies):
     """."""
     if not verify(command.message):
         return
+    ses = session(command)
     alrt = ""
-    if alert:
-        alrt = f"{alert[0]}\n\n"
-        alert.clear()
+    if ses.alert:
+        alrt = f"{ses.alert[0]}\n\n"
+        ses.alert.clear()
     txt = "Do you want this rule to filter traffic directed towards a specific destination?\n(Default: any)\n\nAllowed values for *destination*:\n・ host (e.g. 8.8.8.8)\n・ network (e.g. 8.8.8.8/24)"
-    guide_unreg()
-    dbot.commands.register(name="/b", func=guide_3)
-    dbot.commands.register(name="/s", func=guide_5)
-    dbot.commands.register(name="//", func=guide_4_pl)
+    ses.state = "guide_4"
     d = ""
-    if gmc[4] != gmd[4]:
-        dbot.commands.register(name="/d", func=guide_4_def)
+    if ses.gmc[4] != gmd[4]:
         d = "\n🔺 /d  (default)"
     replies.add(
-        f"{alrt}🌐 GUIDE (5/8)\n{txt}\n\n{guide_r(4)}\n\n🔺 //  *destination*{d}\n🔺 /b  (back)\n🔺 /s  (skip)\n🔺 /q  (quit)"
+        f"{alrt}🌐 GUIDE (5/8)\n{txt}\n\n{guide_r(ses, 4)}\n\n🔺 //  *destination*{d}\n🔺 /b  (back)\n🔺 /s  (skip)\n🔺 /q  (quit)"
     )
 
 
@@ -816,7 +3417,8 @@ def guide_4_def(command, replies):
     """."""
     if not verify(command.message):
         return
-    gmc[4] = gmd[4]
+    ses = session(command)
+    ses.gmc[4] = gmd[4]
     guide_5(command, replies)
 
 
@@ -824,13 +3426,14 @@ def guide_4_pl(command, replies):
     """."""
     if not verify(command.message):
         return
+    ses = session(command)
     pl = [c for c in command.payload.split() if c.strip()]
     if len(pl) != 1:
-        alert.append("⚠️ expects one argument")
+        ses.alert.append("⚠️ expects one argument")
     elif not ufwu.valid_address4(pl[0]):
-        alert.append("⚠️ argument must be host or network")
+        ses.alert.append("⚠️ argument must be host or network")
     else:
-        gmc[4] = pl[0]
+        ses.gmc[4] = pl[0]
         guide_5(command, replies)
         return
     guide_4(command, replies)
@@ -840,21 +3443,18 @@ def guide_5(command, replies):
     """."""
     if not verify(command.message):
         return
+    ses = session(command)
     alrt = ""
-    if alert:
-        alrt = f"{alert[0]}\n\n"
-        alert.clear()
+    if ses.alert:
+        alrt = f"{ses.alert[0]}\n\n"
+        ses.alert.clear()
     txt = "Would you like to restrict this rules filtering to a specific protocol?\n(Default: tcp and udp)\n\nAllowed values for *protocol*:\n・ tcp\n・ udp\n・ esp\n・ gre\n・ ah\n・ igmp\n・ ipv6\n\nWith the exception of default there are some restrictions:\n・ tcp and udp need specification of port(range)s.\n・ All other protocols do not allow port specification but need at least one of source/destination specified.\n(Please consult your favourite search engine to get information about these protocols)."
-    guide_unreg()
-    dbot.commands.register(name="/b", func=guide_4)
-    dbot.commands.register(name="/s", func=guide_6)
-    dbot.commands.register(name="//", func=guide_5_pl)
+    ses.state = "guide_5"
     d = ""
-    if gmc[5] != gmd[5]:
-        dbot.commands.register(name="/d", func=guide_5_def)
+    if ses.gmc[5] != gmd[5]:
         d = "\n🔺 /d  (default)"
     replies.add(
-        f"{alrt}🌐 GUIDE (6/8)\n{txt}\n\n{guide_r(5)}\n\n🔺 //  *protocol*{d}\n🔺 /b  (back)\n🔺 /s  (skip)\n🔺 /q  (quit)"
+        f"{alrt}🌐 GUIDE (6/8)\n{txt}\n\n{guide_r(ses, 5)}\n\n🔺 //  *protocol*{d}\n🔺 /b  (back)\n🔺 /s  (skip)\n🔺 /q  (quit)"
     )
 
 
@@ -862,7 +3462,8 @@ def guide_5_def(command, replies):
     """."""
     if not verify(command.message):
         return
-    gmc[5] = gmd[5]
+    ses = session(command)
+    ses.gmc[5] = gmd[5]
     guide_6(command, replies)
 
 
@@ -870,25 +3471,24 @@ def guide_5_pl(command, replies):
     """."""
     if not verify(command.message):
         return
+    ses = session(command)
     pl = [c for c in command.payload.split() if c.strip()]
     if len(pl) != 1:
-        alert.append("⚠️ expects one argument")
+        ses.alert.append("⚠️ expects one argument")
     elif pl[0] not in ("tcp", "udp", "ah", "esp", "gre", "ipv6", "igmp"):
-        alert.append("⚠️ argument must be tcp, udp, ah, esp, gre, ipv6 or igmp")
+        ses.alert.append("⚠️ argument must be tcp, udp, ah, esp, gre, ipv6 or igmp")
     else:
-        gmc[5] = pl[0]
+        ses.gmc[5] = pl[0]
         guide_6(command, replies)
         return
     guide_5(command, replies)
 
 
-def guide_5_other(replies):
-    txt = f"For protocol {gmc[5]} you must choose source or destination!\nUse  /src  or  /dst  to jump back to those steps or  /b  to go back and change protocol."
-    dbot.commands.register(name="/b", func=guide_5)
-    dbot.commands.register(name="/src", func=guide_3)
-    dbot.commands.register(name="/dst", func=guide_4)
+def guide_5_other(ses, replies):
+    txt = f"For protocol {ses.gmc[5]} you must choose source or destination!\nUse  /src  or  /dst  to jump back to those steps or  /b  to go back and change protocol."
+    ses.state = "guide_5_other"
     replies.add(
-        f"🌐 GUIDE (6/8)\n{txt}\n\n{guide_r(5)}\n\n🔺 /src  (source)\n🔺 /dst  (destination)\n🔺 /b  (back)\n🔺 /q  (quit)"
+        f"🌐 GUIDE (6/8)\n{txt}\n\n{guide_r(ses, 5)}\n\n🔺 /src  (source)\n🔺 /dst  (destination)\n🔺 /b  (back)\n🔺 /q  (quit)"
     )
 
 
@@ -896,31 +3496,29 @@ def guide_6(command, replies):
     """."""
     if not verify(command.message):
         return
-    guide_unreg()
-    if gmc[5] == gmd[5]:
-        guide_6_both(replies)
-    elif gmc[5] in ("tcp", "udp"):
-        guide_6_one(replies)
-    elif gmc[3] == gmd[3] and gmc[4] == gmd[4]:
-        guide_5_other(replies)
+    ses = session(command)
+    if ses.gmc[5] == gmd[5]:
+        guide_6_both(ses, replies)
+    elif ses.gmc[5] in ("tcp", "udp"):
+        guide_6_one(ses, replies)
+    elif ses.gmc[3] == gmd[3] and ses.gmc[4] == gmd[4]:
+        guide_5_other(ses, replies)
     else:
-        guide_6_other(replies)
+        guide_6_other(ses, replies)
 
 
-def guide_6_one(replies):
+def guide_6_one(ses, replies):
     alrt = ""
-    if alert:
-        alrt = f"{alert[0]}\n\n"
-        alert.clear()
-    txt = f"For protocol {gmc[5]} you must choose port(range)s!\n\nAllowed values for *port(range)s*:\n・ a single port (e.g 80)\n・ multiple ports (e.g. 80,443)\n・ a portrange (e.g. 22:44)\n・ multiple portranges (e.g 22:44,55:77)\n・ any combination (e.g 80,55:77,22:44,443)"
-    dbot.commands.register(name="/b", func=guide_5)
-    dbot.commands.register(name="//", func=guide_6_one_pl)
+    if ses.alert:
+        alrt = f"{ses.alert[0]}\n\n"
+        ses.alert.clear()
+    txt = f"For protocol {ses.gmc[5]} you must choose port(range)s!\n\nAllowed values for *port(range)s*:\n・ a single port (e.g 80)\n・ multiple ports (e.g. 80,443)\n・ a portrange (e.g. 22:44)\n・ multiple portranges (e.g 22:44,55:77)\n・ any combination (e.g 80,55:77,22:44,443)"
+    ses.state = "guide_6_one"
     s = ""
-    if gmc[6] != gmd[6]:
-        dbot.commands.register(name="/s", func=guide_7)
+    if ses.gmc[6] != gmd[6]:
         s = "\n🔺 /s  (skip)"
     replies.add(
-        f"{alrt}🌐 GUIDE (7/8)\n{txt}\n\n{guide_r(6)}\n\n🔺 //  *port(range)s*\n🔺 /b  (back){s}\n🔺 /q  (quit)"
+        f"{alrt}🌐 GUIDE (7/8)\n{txt}\n\n{guide_r(ses, 6)}\n\n🔺 //  *port(range)s*\n🔺 /b  (back){s}\n🔺 /q  (quit)"
     )
 
 
@@ -929,6 +3527,7 @@ def guide_6_one_pl(command, replies):
     """."""
     if not verify(command.message):
         return
+    ses = session(command)
     rep = ""
     repp = ["⚠️ arguments for ports must be"]
     repr = ["⚠️ arguments for portranges must be"]
@@ -965,34 +3564,31 @@ def guide_6_one_pl(command, replies):
     elif len(repr) > 1:
         rep = " ".join(repr)
     if rep:
-        alert.append(rep)
-        guide_6_one(replies)
+        ses.alert.append(rep)
+        guide_6_one(ses, replies)
     elif pl:
-        gmc[6] = command.payload
+        ses.gmc[6] = command.payload
         guide_7(command, replies)
     else:
-        alert.append("⚠️ expects argument")
-        guide_6_one(replies)
+        ses.alert.append("⚠️ expects argument")
+        guide_6_one(ses, replies)
 
 
-def guide_6_both(replies):
+def guide_6_both(ses, replies):
     alrt = ""
-    if alert:
-        alrt = f"{alert[0]}\n\n"
-        alert.clear()
-    txt = f"For protocol {gmc[5]} you may choose a port.\n(Default: any)\n\nAllowed values for *port*:\n・ a single port (e.g 80)"
-    dbot.commands.register(name="/b", func=guide_5)
-    dbot.commands.register(name="//", func=guide_6_both_pl)
+    if ses.alert:
+        alrt = f"{ses.alert[0]}\n\n"
+        ses.alert.clear()
+    txt = f"For protocol {ses.gmc[5]} you may choose a port.\n(Default: any)\n\nAllowed values for *port*:\n・ a single port (e.g 80)"
+    ses.state = "guide_6_both"
     s = ""
     d = ""
-    if not any(c in gmc[6] for c in (",", ":")):
-        dbot.commands.register(name="/s", func=guide_7)
+    if not any(c in ses.gmc[6] for c in (",", ":")):
         s = "\n🔺 /s  (skip)"
-    if gmc[6] != gmd[6]:
-        dbot.commands.register(name="/d", func=guide_6_both_def)
+    if ses.gmc[6] != gmd[6]:
         d = "\n🔺 /d  (default)"
     replies.add(
-        f"{alrt}🌐 GUIDE (7/8)\n{txt}\n\n{guide_r(6)}\n\n🔺 //  *port*{d}\n🔺 /b  (back){s}\n🔺 /q  (quit)"
+        f"{alrt}🌐 GUIDE (7/8)\n{txt}\n\n{guide_r(ses, 6)}\n\n🔺 //  *port*{d}\n🔺 /b  (back){s}\n🔺 /q  (quit)"
     )
 
 
@@ -1000,7 +3596,8 @@ def guide_6_both_def(command, replies):
     """."""
     if not verify(command.message):
         return
-    gmc[6] = gmd[6]
+    ses = session(command)
+    ses.gmc[6] = gmd[6]
     guide_7(command, replies)
 
 
@@ -1008,34 +3605,33 @@ def guide_6_both_pl(command, replies):
     """."""
     if not verify(command.message):
         return
+    ses = session(command)
     pl = [c for c in re.split(",|:", command.payload) if c.strip()]
     if len(pl) != 1:
-        alert.append("⚠️ expects one argument")
+        ses.alert.append("⚠️ expects one argument")
     elif not pl[0].isnumeric():
-        alert.append("⚠️ argument must be numeric")
+        ses.alert.append("⚠️ argument must be numeric")
     elif int(pl[0]) <= 0 or int(pl[0]) > 65535:
-        alert.append("⚠️ argument must be valid portnumber")
+        ses.alert.append("⚠️ argument must be valid portnumber")
     else:
-        gmc[6] = pl[0]
+        ses.gmc[6] = pl[0]
         guide_7(command, replies)
         return
-    guide_6_both(replies)
+    guide_6_both(ses, replies)
 
 
-def guide_6_other(replies):
-    txt = f"No port specification is allowed for protocol {gmc[5]}!"
-    dbot.commands.register(name="/b", func=guide_5)
+def guide_6_other(ses, replies):
+    txt = f"No port specification is allowed for protocol {ses.gmc[5]}!"
+    ses.state = "guide_6_other"
     s = ""
     d = ""
-    if gmc[6] == gmd[6]:
-        dbot.commands.register(name="/s", func=guide_7)
+    if ses.gmc[6] == gmd[6]:
         s = "\n🔺 /s  (skip)"
     else:
-        dbot.commands.register(name="/d", func=guide_6_other_def)
         d = "\n🔺 /d  (default)"
         txt = f"{txt}\n\nPlease use  /d  to set ports to default (any) or  /b  to go back and choose a different protocol"
     replies.add(
-        f"🌐 GUIDE (7/8)\n{txt}\n\n{guide_r(6)}\n{d}\n🔺 /b  (back){s}\n🔺 /q  (quit)"
+        f"🌐 GUIDE (7/8)\n{txt}\n\n{guide_r(ses, 6)}\n{d}\n🔺 /b  (back){s}\n🔺 /q  (quit)"
     )
 
 
@@ -1043,7 +3639,8 @@ def guide_6_other_def(command, replies):
     """."""
     if not verify(command.message):
         return
-    gmc[6] = gmd[6]
+    ses = session(command)
+    ses.gmc[6] = gmd[6]
     guide_7(command, replies)
 
 
@@ -1051,21 +3648,18 @@ def guide_7(command, replies):
     """."""
     if not verify(command.message):
         return
+    ses = session(command)
     alrt = ""
-    if alert:
-        alrt = f"{alert[0]}\n\n"
-        alert.clear()
+    if ses.alert:
+        alrt = f"{ses.alert[0]}\n\n"
+        ses.alert.clear()
     txt = "Would you like to add a comment to this rule?\nThis setting is optional (Default: None)\n\nYou may specify a comment using  // whateveryoulikeincludingspacesandsuch"
-    guide_unreg()
-    dbot.commands.register(name="/b", func=guide_6)
-    dbot.commands.register(name="/s", func=guide_finish)
-    dbot.commands.register(name="//", func=guide_7_pl)
+    ses.state = "guide_7"
     d = ""
-    if gmc[7] != gmd[7]:
-        dbot.commands.register(name="/d", func=guide_7_def)
+    if ses.gmc[7] != gmd[7]:
         d = "\n🔺 /d  (default)"
     replies.add(
-        f"{alrt}🌐 GUIDE (8/8)\n{txt}\n\n{guide_r(7)}\n\n🔺 //  *comment*{d}\n🔺 /b  (back)\n🔺 /s  (skip)\n🔺 /q  (quit)"
+        f"{alrt}🌐 GUIDE (8/8)\n{txt}\n\n{guide_r(ses, 7)}\n\n🔺 //  *comment*{d}\n🔺 /b  (back)\n🔺 /s  (skip)\n🔺 /q  (quit)"
     )
 
 
@@ -1073,7 +3667,8 @@ def guide_7_def(command, replies):
     """."""
     if not verify(command.message):
         return
-    gmc[7] = gmd[7]
+    ses = session(command)
+    ses.gmc[7] = gmd[7]
     guide_finish(command, replies)
 
 
@@ -1081,11 +3676,12 @@ def guide_7_pl(command, replies):
     """."""
     if not verify(command.message):
         return
+    ses = session(command)
     if not command.payload:
-        alert.append("⚠️ expects comment")
+        ses.alert.append("⚠️ expects comment")
         guide_7(command, replies)
     else:
-        gmc[7] = command.payload
+        ses.gmc[7] = command.payload
         guide_finish(command, replies)
 
 
@@ -1093,19 +3689,18 @@ def guide_finish(command, replies):
     """."""
     if not verify(command.message):
         return
+    ses = session(command)
     alrt = ""
-    if alert:
-        alrt = f"{alert[0]}\n\n"
-        alert.clear()
+    if ses.alert:
+        alrt = f"{ses.alert[0]}\n\n"
+        ses.alert.clear()
     x = "add"
-    if gmc[0] != gmd[0]:
+    if ses.gmc[0] != gmd[0]:
         x = "insert"
     txt = f"Rule building is done.\nPlease check if the rule below matches your expectation, if so you may use  /f  to {x} this rule and finish this guide."
-    guide_unreg()
-    dbot.commands.register(name="/b", func=guide_6)
-    dbot.commands.register(name="/f", func=guide_exec)
+    ses.state = "guide_finish"
     replies.add(
-        f"{alrt}🌐 GUIDE\n{txt}\n\n{guide_r(8)}\n\n🔺 /f  (finish)\n🔺 /b  (back)\n🔺 /q  (quit)"
+        f"{alrt}🌐 GUIDE\n{txt}\n\n{guide_r(ses, 8)}\n\n🔺 /f  (finish)\n🔺 /b  (back)\n🔺 /q  (quit)"
     )
 
 
@@ -1113,76 +3708,948 @@ def guide_exec(command, replies):
     """."""
     if not verify(command.message):
         return
-    clear_cmd()
+    ses = session(command)
     p = ufwp.UFWParser()
-    for c in ["b", "f", "q"]:
-        with suppress(Exception):
-            dbot.commands.unregister(name=f"/{c}")
     x = []
-    if gmc[0] != gmd[0]:
+    if ses.gmc[0] != gmd[0]:
         x.append("insert")
-        x.append(gmc[0])
+        x.append(ses.gmc[0])
         p.register_command(ufwp.UFWCommandRule("insert"))
-    x.append(gmc[2])
-    if gmc[1] != gmd[1]:
+    x.append(ses.gmc[2])
+    if ses.gmc[1] != gmd[1]:
         x.append("out")
     x.append("from")
-    if gmc[3] != gmd[3]:
-        x.append(gmc[3])
+    if ses.gmc[3] != gmd[3]:
+        x.append(ses.gmc[3])
     else:
         x.append(gmd[3])
     x.append("to")
-    if gmc[4] != gmd[4]:
-        x.append(gmc[4])
+    if ses.gmc[4] != gmd[4]:
+        x.append(ses.gmc[4])
     else:
         x.append(gmd[4])
-    if gmc[5] != gmd[5]:
+    if ses.gmc[5] != gmd[5]:
         x.append("proto")
-        x.append(gmc[5])
-    if gmc[6] != gmd[6]:
+        x.append(ses.gmc[5])
+    if ses.gmc[6] != gmd[6]:
         x.append("port")
-        x.append(gmc[6])
-    if gmc[7] != gmd[7]:
+        x.append(ses.gmc[6])
+    if ses.gmc[7] != gmd[7]:
         x.append("comment")
-        x.append(gmc[7])
-    p.register_command(ufwp.UFWCommandRule(gmc[2]))
+        x.append(ses.gmc[7])
+    p.register_command(ufwp.UFWCommandRule(ses.gmc[2]))
     try:
         pr = p.parse_command(x)
-        fw()[0].do_action(
-            pr.action,
-            pr.data.get("rule", ""),
-            pr.data.get("iptype", ""),
-            True,
-        )
+        fw_do(pr)
     except Exception as xcp:
-        alert.append(f"⛔️ ufw exception: {xcp}")
+        ses.alert.append(f"⛔️ ufw exception: {xcp}")
         guide_finish(command, replies)
         return
     except:
-        alert.append(f"📛 ufw error")
+        ses.alert.append("📛 ufw error")
         guide_finish(command, replies)
         return
-    x = []
-    for c in fw()[1].get_rules():
-        x.append(f"🔹 {len(x) + 1}:  {ufwp.UFWCommandRule.get_command(c)}")
-    x = "\n".join(x)
+    x = "\n".join([f"🔹 {c.num}:  {c.cmd}" for c in ruleset().recs])
     replies.add(f"🌐 RULES\n{x}")
-    gmc.clear()
-    menu()
+    ses.gmc.clear()
+    ses.state = "menu"
 
 
 # >>> SCAN
 
 
+class Rtt:
+    """Probe timeout from smoothed round trips, like TCP's retransmit timer."""
+
+    def __init__(self, first=1.0, lo=0.05, hi=3.0):
+        self.first = first
+        self.lo = lo
+        self.hi = hi
+        self.srtt = None
+        self.var = None
+
+    def sample(self, x):
+        if self.srtt is None:
+            self.srtt, self.var = x, x / 2
+        else:
+            self.var = 0.75 * self.var + 0.25 * abs(self.srtt - x)
+            self.srtt = 0.875 * self.srtt + 0.125 * x
+
+    def timeout(self):
+        if self.srtt is None:
+            return self.first
+        return min(max(self.srtt + 4 * self.var, self.lo), self.hi)
+
+
+class Bucket:
+    """Token bucket of rate probes per second, bursts of a tenth of that."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.size = max(rate / 10, 1)
+        self.tokens = self.size
+        self.at = time.monotonic()
+
+    async def take(self):
+        while self.rate:
+            now = time.monotonic()
+            self.tokens = min(self.tokens + (now - self.at) * self.rate, self.size)
+            self.at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+async def scan_tcp(fam, addr, port, rtt):
+    loop = asyncio.get_running_loop()
+    s = socket.socket(fam, socket.SOCK_STREAM)
+    s.setblocking(False)
+    t = time.monotonic()
+    try:
+        # loopback answers right away, the event loop is only for the rest
+        e = s.connect_ex((addr, port))
+        if e == errno.ECONNREFUSED:
+            raise ConnectionRefusedError()
+        if e not in (0, errno.EINPROGRESS):
+            raise OSError(e, os.strerror(e))
+        if e:
+            await asyncio.wait_for(loop.sock_connect(s, (addr, port)), rtt.timeout())
+        rtt.sample(time.monotonic() - t)
+        # a local port picked equal to the target connects to itself
+        if s.getsockname()[:2] == s.getpeername()[:2]:
+            return "closed"
+        # reset instead of a fin, no TIME_WAIT per open port
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        return "open"
+    except ConnectionRefusedError:
+        rtt.sample(time.monotonic() - t)
+        return "closed"
+    except (asyncio.TimeoutError, OSError):
+        return "filtered"
+    finally:
+        s.close()
+
+
+# an empty datagram, a reply means open and an icmp unreachable closed
+async def scan_udp(fam, addr, port, rtt):
+    loop = asyncio.get_running_loop()
+    s = socket.socket(fam, socket.SOCK_DGRAM)
+    s.setblocking(False)
+    t = time.monotonic()
+    try:
+        s.connect((addr, port))
+        s.send(b"")
+        await asyncio.wait_for(loop.sock_recv(s, 512), rtt.timeout())
+        rtt.sample(time.monotonic() - t)
+        return "open"
+    except ConnectionRefusedError:
+        rtt.sample(time.monotonic() - t)
+        return "closed"
+    except asyncio.TimeoutError:
+        return "open|filtered"
+    except OSError:
+        return "filtered"
+    finally:
+        s.close()
+
+
+# at most conc probes in flight, only as many tasks as that exist at a time
+async def scan_run(fam, addr, ranges, proto, conc, rate):
+    sem = asyncio.Semaphore(conc)
+    rtt = Rtt()
+    bucket = Bucket(rate)
+    probe = scan_tcp if proto == "tcp" else scan_udp
+    res = {}
+    tasks = set()
+
+    async def one(port):
+        try:
+            await bucket.take()
+            res[port] = await probe(fam, addr, port, rtt)
+        finally:
+            sem.release()
+
+    for lo, hi in ranges:
+        for port in range(lo, hi + 1):
+            await sem.acquire()
+            t = asyncio.ensure_future(one(port))
+            tasks.add(t)
+            t.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.gather(*tasks)
+    return res
+
+
+# bounded by the open file limit, some descriptors stay for the bot
+def scan_conc():
+    x = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    if x == resource.RLIM_INFINITY:
+        x = 4096
+    return max(min(x - 256, 2048), 16)
+
+
+# ports with a listener that accepts connections to addr
+def scan_listening(addr, proto):
+    a = ipaddress.ip_address(addr)
+    x = set()
+    for c, d in listeners(True).items():
+        if c.rstrip("6") != proto:
+            continue
+        for port, e in d.items():
+            for f in e:
+                g = ipaddress.ip_address(f["laddr"])
+                if g == a or g.is_unspecified and (g.version == a.version or c.endswith("6")):
+                    x.add(int(port))
+    return x
+
+
 def scan(command, replies):
     """."""
     if not verify(command.message):
         return
+    ses = session(command)
+    ses.state = "menu"
+    x = "\n\n🔺 /scan  [*host*]  [*ports*]  [tcp|udp]\nScans this host (default 127.0.0.1, 1:65535, tcp) or another one and compares open ports with listeners and rules."
+    host, spec, proto = "127.0.0.1", "1:65535", "tcp"
+    for c in command.payload.split():
+        if c in ("tcp", "udp"):
+            proto = c
+        elif re.fullmatch(r"[\d,:-]+", c):
+            spec = c.replace("-", ":")
+        else:
+            host = c
+    try:
+        ranges = port_ranges(spec)
+        fam, _, _, _, sa = socket.getaddrinfo(host, None, proto=socket.IPPROTO_TCP)[0]
+    except (ValueError, OSError):
+        replies.add(f"⚠️ invalid host or ports{x}")
+        return
+    addr = sa[0]
+    a = ipaddress.ip_address(addr)
+    local = a.is_loopback or a in facts.interfaces()
+    t = time.monotonic()
+    res = asyncio.run(scan_run(fam, addr, ranges, proto, scan_conc(), 0 if local else 1000))
+    t = time.monotonic() - t
+    lst = scan_listening(addr, proto) if local else set()
+    # udp listeners usually don't answer an empty datagram
+    opn = sorted([c for c, d in res.items() if d == "open" or d == "open|filtered" and c in lst])
+    y = [
+        f"🌐 SCAN\n🔹 host:  '{host}'\n🔹 ports:  '{len(res)} {proto}'\n🔹 time:  '{t:.1f}s'\n🔹 open:  '{len(opn)}'"
+    ]
+    z = len([c for c, d in res.items() if d in ("filtered", "open|filtered") and c not in opn])
+    if z:
+        y[0] += f"\n🔹 no answer:  '{z}'"
+    w = []
+    if local:
+        cls = classifier()
+        pol = fw()[1]._get_default_policy("input")
+        for port in sorted(set(opn) | {c for c in lst if c in res}):
+            v = test_outside(cls, pol, proto, a, port)[1]
+            if port in opn and port not in lst:
+                w.append(f"⚠️ {port}/{proto}: open without a listener here, {v}")
+            elif port not in opn:
+                w.append(f"⚠️ {port}/{proto}: listener but {res[port]}, {v}")
+            else:
+                w.append(f"🔸 {port}/{proto}: open, {v}")
+    else:
+        w = [f"🔸 {c}/{proto}: open" for c in opn]
+    if len(w) > 50:
+        w = w[:50] + [f"🔸 ... and {len(w) - 50} more"]
+    if w:
+        y.append("\n".join(w))
+    replies.add("\n\n".join(y) + x)
+
+
+# >>> WATCH
+
+
+class Watch:
+    """Tells the admins about new listeners and rules changed outside the bot.
+
+    A poll costs one sock_diag dump and two stats of the user rules files.
+    The rules are only read when the files changed since the last poll and
+    the change isn't the stamp the mutation worker left after its last job.
+    Listeners have to be there on two polls in a row, which hides short
+    lived udp sockets.
+    """
+
+    def __init__(self):
+        self.on = True
+        self.every = 60
+        self.wake = threading.Condition()
+        self.files = ()
+        self.own = None
+        self.stamp = None
+        self.cmds = None
+        self.known = None
+        self.last = frozenset()
+
+    def load(self):
+        with suppress(ValueError, AttributeError):
+            x = dbot.get("watch").split()
+            self.on = x[0] == "on"
+            self.every = int(x[1])
+
+    def save(self):
+        dbot.set("watch", f"{'on' if self.on else 'off'} {self.every}")
+        with self.wake:
+            self.wake.notify()
+
+    def start(self):
+        threading.Thread(target=self.run, name="fwbot-watch", daemon=True).start()
+
+    # called by the mutation worker after each job, with fwlock held
+    def settle(self):
+        if self.files:
+            self.own = fw_stamp(self.files)
+
+    def run(self):
+        while True:
+            if self.on:
+                try:
+                    x = self.poll()
+                    if x:
+                        admins("👀 WATCH\n" + "\n\n".join(x))
+                except Exception as xcp:
+                    dbot.logger.exception(xcp)
+            with self.wake:
+                self.wake.wait(self.every if self.on else None)
+
+    def poll(self):
+        x = []
+        socks = {c[:3]: c[4] for c in listen_sockets(True)}
+        cur = frozenset(socks)
+        if self.known is None:
+            self.known = cur
+        else:
+            new = (cur & self.last) - self.known
+            gone = self.known - cur - self.last
+            self.known = (self.known - gone) | new
+            if new:
+                x.append(self.listeners(new, socks))
+            if gone:
+                x.append(
+                    "🔸 listeners gone\n"
+                    + "\n".join([f"🔹 {watch_addr(c)}" for c in sorted(gone)[:20]])
+                )
+        self.last = cur
+        # a busy worker is changing the rules, they are looked at next time
+        if not fwlock.acquire(blocking=False):
+            return x
+        try:
+            if not self.files:
+                b = fw()[1]
+                self.files = (b.files["rules"], b.files["rules6"])
+            stamp = fw_stamp(self.files)
+            if stamp != self.stamp:
+                cmds = [c.cmd for c in ruleset().recs]
+                if self.cmds is not None and stamp != self.own:
+                    y = self.diff(cmds)
+                    if y:
+                        x.append(y)
+                self.stamp, self.cmds = stamp, cmds
+        finally:
+            fwlock.release()
+        return x
+
+    def listeners(self, new, socks):
+        x = []
+        owners = proc_owners([socks[c] for c in new if socks.get(c, "0") != "0"])
+        cls = classifier()
+        pol = fw()[1]._get_default_policy("input")
+        for c in sorted(new):
+            a = ipaddress.ip_address(c[1])
+            exe = owners.get(socks.get(c), ("-", None, "-"))[2]
+            if a.is_loopback:
+                x.append(f"🔹 {watch_addr(c)}:  '{exe}, local only'")
+                continue
+            v, d = test_outside(cls, pol, c[0].rstrip("6"), a, c[2])
+            if v in ("allow", "limit"):
+                x.append(f"⚠️ {watch_addr(c)}:  '{exe}, {d}'")
+            else:
+                x.append(f"🔹 {watch_addr(c)}:  '{exe}, {d}'")
+        if len(x) > 20:
+            x = x[:20] + [f"🔸 ... and {len(x) - 20} more"]
+        return "🔸 new listeners\n" + "\n".join(x)
+
+    def diff(self, cmds):
+        a, b = Counter(self.cmds), Counter(cmds)
+        add, rem = b - a, a - b
+        if not add and not rem:
+            return "🔸 rules reordered outside the bot" if cmds != self.cmds else None
+        x = [f"➕ '{c}'" for c in add.elements()] + [f"➖ '{c}'" for c in rem.elements()]
+        if len(x) > 20:
+            x = x[:20] + [f"🔸 ... and {len(x) - 20} more"]
+        return "🔸 rules changed outside the bot\n" + "\n".join(x)
+
+
+def watch_addr(x):
+    a = f"[{x[1]}]" if ":" in x[1] else x[1]
+    return f"{a}:{x[2]}/{x[0].rstrip('6')}"
+
+
+watch = Watch()
+
+
+def watch_cmd(command, replies):
+    """."""
+    if not verify(command.message):
+        return
+    ses = session(command)
+    ses.state = "menu"
+    pl = command.payload.split()
+    alrt = ""
+    if len(pl) == 1 and pl[0] in ("on", "off"):
+        watch.on = pl[0] == "on"
+        watch.save()
+    elif len(pl) == 2 and pl[0] == "every" and dur_secs(pl[1]):
+        watch.every = max(dur_secs(pl[1]), 5)
+        watch.save()
+    elif pl:
+        alrt = "⚠️ invalid argument(s)\n\n"
+    w = watch
+    replies.add(
+        f"{alrt}🌐 WATCH\n🔹 watch:  '{'on' if w.on else 'off'}'\n🔹 every:  '{ttl_fmt(w.every)}'\n🔹 listeners:  '{len(w.known or ())}'\n🔹 rules:  '{len(w.cmds or ())}'\n\n🔺 /watch  on|off\nTells this group about new listeners and rules changed outside the bot.\n\n🔺 /watch  every  *duration*\nSet how often to look (e.g. 30s)."
+    )
+
+
+# >>> SNAPSHOTS
+
+# what a snapshot holds, the default policies live in defaults
+skeys = ("defaults", "before_rules", "after_rules", "rules", "before6_rules", "after6_rules", "rules6")
+spat = re.compile(r"^[A-Za-z0-9_.-]{1,32}$")
+
+
+# chunks end after lines picked by their hash, so an edit only changes the
+# chunks around it and the others are shared with earlier snapshots
+def snap_chunks(data):
+    x = []
+    y = []
+    for c in data.splitlines(True):
+        y.append(c)
+        if len(y) >= 64 or len(y) >= 4 and zlib.crc32(c) & 15 == 0:
+            x.append(b"".join(y))
+            y = []
+    if y:
+        x.append(b"".join(y))
+    return x
+
+
+# the files are stored as lists of chunks, chunks by their hash and only once,
+# returns the number of new chunks and their compressed size
+def snap_save(b, name):
+    x = {}
+    m = []
+    for k in skeys:
+        try:
+            with open(b.files[k], "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            continue
+        y = [k]
+        for c in snap_chunks(data):
+            h = hashlib.blake2b(c, digest_size=16).digest()
+            x[h] = c
+            y.append(h.hex())
+        m.append(" ".join(y))
+    n = [0, 0]
+    with dblock:
+        db = store()
+        db.execute("BEGIN")
+        try:
+            for h, c in x.items():
+                if db.execute("SELECT 1 FROM chunk WHERE hash = ?", (h,)).fetchone() is None:
+                    z = zlib.compress(c, 6)
+                    db.execute("INSERT INTO chunk (hash, data) VALUES (?, ?)", (h, z))
+                    n[0] += 1
+                    n[1] += len(z)
+            db.execute(
+                "INSERT OR REPLACE INTO snapshot (name, at, files) VALUES (?, ?, ?)",
+                (name, time.time(), "\n".join(m)),
+            )
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+    return n
+
+
+# file key -> content, None if there is no such snapshot
+def snap_files(name):
+    with dblock:
+        db = store()
+        m = db.execute("SELECT files FROM snapshot WHERE name = ?", (name,)).fetchone()
+        if m is None:
+            return None
+        x = {}
+        for c in m[0].splitlines():
+            k, *hs = c.split(" ")
+            y = []
+            for h in hs:
+                z = db.execute("SELECT data FROM chunk WHERE hash = ?", (bytes.fromhex(h),)).fetchone()
+                if z is None:
+                    raise ufwc.UFWError(f"snapshot {name} is missing data")
+                y.append(zlib.decompress(z[0]))
+            x[k] = b"".join(y)
+    return x
+
+
+# chunks no snapshot uses anymore are dropped with the snapshot
+def snap_delete(name):
+    with dblock:
+        db = store()
+        db.execute("BEGIN")
+        try:
+            n = db.execute("DELETE FROM snapshot WHERE name = ?", (name,)).rowcount
+            y = set()
+            for (c,) in db.execute("SELECT files FROM snapshot"):
+                for d in c.splitlines():
+                    y.update(d.split(" ")[1:])
+            z = [h for (h,) in db.execute("SELECT hash FROM chunk") if h.hex() not in y]
+            db.executemany("DELETE FROM chunk WHERE hash = ?", [(h,) for h in z])
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+    return n
+
+
+# blocklists the before rules of a snapshot refer to are created empty if
+# they were removed since, iptables-restore fails on a missing set
+def snap_sets(b, files):
+    x = set()
+    for k in ("before_rules", "before6_rules"):
+        x.update([c.decode() for c in re.findall(rb"--match-set (\S+)", files.get(k, b""))])
+    if not x:
+        return []
+    y = set(block_ipset("list", "-n").split())
+    z = []
+    for c in sorted(x - y):
+        if not c.startswith(("fwbot-", "fwbot6-")):
+            raise ufwc.UFWError(f"set {c} doesn't exist")
+        d = "inet6" if c.startswith("fwbot6-") else "inet"
+        block_ipset("create", c, "hash:net", "family", d, "-exist")
+        z.append(c.split("-", 1)[1])
+    if z:
+        block_save(b)
+    return sorted(set(z))
+
+
+# writes the changed files and swaps all chains in one restore per ip version,
+# the old files are put back if that fails
+def snap_restore(b, files):
+    old = {}
+    for k in files:
+        with suppress(FileNotFoundError), open(b.files[k], "rb") as f:
+            old[k] = f.read()
+    new = snap_sets(b, files)
+    x = [k for k, d in files.items() if old.get(k) != d]
+    on = b.is_enabled()
+    try:
+        for k in x:
+            block_write(b.files[k], files[k])
+        fw_invalidate()
+        if on:
+            policy_load(fw()[1], True)
+    except Exception:
+        for k in x:
+            if k in old:
+                block_write(b.files[k], old[k])
+        fw_invalidate()
+        if on:
+            with suppress(Exception):
+                b = fw()[1]
+                b.stop_firewall()
+                b.start_firewall()
+        raise
+    finally:
+        fw_invalidate()
+    return (x, new)
+
+
+def snap_list():
+    with dblock:
+        db = store()
+        x = db.execute("SELECT name, at FROM snapshot ORDER BY at DESC").fetchall()
+        y = db.execute("SELECT count(*), coalesce(sum(length(data)), 0) FROM chunk").fetchone()
+    return (x, y)
+
+
+def snapshot(command, replies):
+    """."""
+    if not verify(command.message):
+        return
+    ses = session(command)
+    ses.state = "menu"
+    pl = command.payload.split()
+    b = fw()[1]
+    alrt = ""
+    try:
+        if len(pl) == 2 and not spat.match(pl[1]):
+            alrt = "⚠️ names are up to 32 letters, digits, ., - or _"
+        elif pl and pl[0] == "save" and len(pl) <= 2:
+            name = pl[1] if len(pl) == 2 else time.strftime("%Y%m%d-%H%M%S")
+            n = snap_save(b, name)
+            alrt = f"📸 snapshot {name} saved, {n[0]} new chunks ({hot_num(n[1])}B)"
+        elif len(pl) == 2 and pl[0] == "restore":
+            x = snap_files(pl[1])
+            if x is None:
+                alrt = f"⚠️ no snapshot {pl[1]}"
+            else:
+                t = time.monotonic()
+                y, z = snap_restore(b, x)
+                t = time.monotonic() - t
+                alrt = f"✅ snapshot {pl[1]} restored in {t:.1f}s, {len(y)} files changed"
+                if z:
+                    alrt += f"\n🔸 empty blocklists created: {', '.join(z)}"
+        elif len(pl) == 2 and pl[0] == "del":
+            if snap_delete(pl[1]):
+                alrt = f"🔸 snapshot {pl[1]} removed"
+            else:
+                alrt = f"⚠️ no snapshot {pl[1]}"
+        elif pl and pl != ["list"]:
+            alrt = "⚠️ unknown or incomplete subcommand"
+    except (OSError, ufwc.UFWError) as xcp:
+        alrt = f"⛔️ ufw exception: {xcp}"
+    if alrt:
+        alrt = f"{alrt}\n\n"
+    x, y = snap_list()
+    z = "\n".join(
+        [f"🔹 {c}:  '{time.strftime('%Y-%m-%d %H:%M', time.localtime(d))}'" for c, d in x[:30]]
+    )
+    if len(x) > 30:
+        z += f"\n🔸 ... and {len(x) - 30} more"
     replies.add(
-        f"🌐 SCAN\nPlease check\nhttps://github.com/janekc/firewall-bot for version greater than {version}"
+        f"{alrt}🌐 SNAPSHOTS\n{z or '🔸 no snapshots'}\n🔸 {y[0]} chunks, {hot_num(y[1])}B stored\n\n🔺 /snapshot  save  [*name*]\nSaves the rules, before and after rules and default policies.\n\n🔺 /snapshot  restore  *name*\nPuts a snapshot back in place and reloads the firewall at once.\n\n🔺 /snapshot  del  *name*\n🔺 /snapshot  list\nRemoves a snapshot or shows them all."
     )
 
 
+# >>> AUDIT
+
+
+class Audit:
+    """Who changed what, taken around each job of the mutation worker.
+
+    The state before a job is the cached ruleset, policies and status, the
+    one after it is diffed against that. Entries are queued for a writer
+    thread that puts everything queued meanwhile in one transaction, so the
+    worker never waits for the disk. The tables can only be appended to.
+    """
+
+    def __init__(self, batch=1000, delay=0.05):
+        self.batch = batch
+        self.delay = delay
+        self.q = queue.Queue()
+
+    def start(self):
+        threading.Thread(target=self.run, name="fwbot-audit", daemon=True).start()
+
+    @staticmethod
+    def state():
+        b = fw()[1]
+        pol = (b._get_default_policy(), b._get_default_policy("output"))
+        return ([c.cmd for c in ruleset().recs], pol, b.is_enabled())
+
+    # called by the mutation worker with fwlock held
+    def before(self):
+        try:
+            return self.state()
+        except Exception as xcp:
+            dbot.logger.exception(xcp)
+            return None
+
+    def after(self, job, old):
+        try:
+            if isinstance(job, partial) and job.func is later:
+                m = job.args[1].message
+                who, chat, cmd = m.get_sender_contact().addr, m.chat.id, m.text
+            else:
+                f = job.func if isinstance(job, partial) else job
+                who, chat, cmd = "bot", 0, getattr(f, "__name__", "job")
+            x = []
+            y = []
+            if old is not None:
+                new = self.state()
+                if old[2] != new[2]:
+                    x.append(f"status: {'active' if new[2] else 'inactive'}")
+                if old[1] != new[1]:
+                    x.append(f"policy: {' '.join(old[1])} -> {' '.join(new[1])}")
+                a, b = Counter(old[0]), Counter(new[0])
+                x += [f"+ {c}" for c in (b - a).elements()]
+                x += [f"- {c}" for c in (a - b).elements()]
+                y = sorted(set((a - b) | (b - a)))
+            self.q.put((time.time(), who, chat, cmd, "\n".join(x), y))
+        except Exception as xcp:
+            dbot.logger.exception(xcp)
+
+    def run(self):
+        while True:
+            x = [self.q.get()]
+            # whatever comes in meanwhile shares the commit
+            time.sleep(self.delay)
+            while len(x) < self.batch:
+                try:
+                    x.append(self.q.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.write(x)
+            except Exception as xcp:
+                dbot.logger.exception(xcp)
+
+    def write(self, x):
+        with dblock:
+            db = store()
+            db.execute("BEGIN")
+            try:
+                for c in x:
+                    i = db.execute(
+                        "INSERT INTO audit (ts, actor, chat, cmd, diff) VALUES (?, ?, ?, ?, ?)",
+                        c[:5],
+                    ).lastrowid
+                    db.executemany(
+                        "INSERT OR IGNORE INTO audit_rule (rule, id) VALUES (?, ?)",
+                        [(d, i) for d in c[5]],
+                    )
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+
+
+audit = Audit()
+
+
+# newest first, rule matches the start of a rule's command
+def audit_query(who=None, rule=None, since=None, limit=10):
+    q = []
+    a = []
+    if who:
+        q.append("actor = ?")
+        a.append(who)
+    if since:
+        since = time.time() - since
+        q.append("ts >= ?")
+        a.append(since)
+    cols = "SELECT id, ts, actor, chat, cmd, diff FROM audit"
+    with dblock:
+        db = store()
+        if not rule:
+            w = f"WHERE {' AND '.join(q)}" if q else ""
+            return db.execute(f"{cols} {w} ORDER BY ts DESC LIMIT ?", (*a, limit)).fetchall()
+        # ids follow time, the newest ids of the rule index are taken a page
+        # at a time below the last one seen and the other filters applied,
+        # a prefix of many rules walks the ids instead of sorting its matches
+        r = (rule, rule + "\U0010ffff")
+        y = "SELECT id FROM audit_rule WHERE rule >= ? AND rule < ? AND id < ? ORDER BY id DESC LIMIT 500"
+        z = "SELECT count(*) FROM (SELECT 1 FROM audit_rule WHERE rule >= ? AND rule < ? LIMIT 5000)"
+        if db.execute(z, r).fetchone()[0] >= 5000:
+            y = y.replace("audit_rule", "audit_rule INDEXED BY audit_rule_id", 1)
+        x = {}
+        n = 1 << 62
+        while len(x) < limit:
+            ids = db.execute(y, (*r, n)).fetchall()
+            if not ids:
+                break
+            n = ids[-1][0]
+            w = " AND ".join(q + [f"id IN ({','.join('?' * len(ids))})"])
+            for c in db.execute(f"{cols} WHERE {w} ORDER BY id DESC", (*a, *[c[0] for c in ids])):
+                x.setdefault(c[0], c)
+            if since and db.execute("SELECT ts FROM audit WHERE id = ?", ids[-1]).fetchone()[0] < since:
+                break
+        return sorted(x.values(), reverse=True)[:limit]
+
+
+def audit_cmd(command, replies):
+    """."""
+    if not verify(command.message):
+        return
+    ses = session(command)
+    ses.state = "menu"
+    pl = command.payload.split()
+    x = "\n\n🔺 /audit  [by *address*]  [since *duration*]  [last *n*]  [rule *text*]\nShows the latest firewall changes, who made them and how the rules changed. rule matches the beginning of rules as /rules shows them and must come last."
+    kw = {}
+    while pl:
+        c = pl.pop(0)
+        if c == "by" and pl:
+            kw["who"] = pl.pop(0)
+        elif c == "since" and pl and dur_secs(pl[0]):
+            kw["since"] = dur_secs(pl.pop(0))
+        elif c == "last" and pl and pl[0].isnumeric() and 0 < int(pl[0]) <= 50:
+            kw["limit"] = int(pl.pop(0))
+        elif c == "rule" and pl:
+            kw["rule"] = " ".join(pl)
+            pl = []
+        else:
+            replies.add(f"⚠️ invalid argument(s){x}")
+            return
+    t = time.monotonic()
+    y = audit_query(**kw)
+    t = time.monotonic() - t
+    z = []
+    for i, ts, who, chat, cmd, diff in y:
+        d = [f"🔹 {i}:  '{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts))}'  {who}"]
+        d.append(f"🔸 '{cmd if len(cmd) <= 200 else cmd[:200] + ' ...'}'")
+        e = diff.splitlines()
+        for c in e[:10]:
+            if c[:2] in ("+ ", "- "):
+                d.append(f"{'➕' if c[0] == '+' else '➖'} '{c[2:]}'")
+            else:
+                d.append(f"🔸 {c}")
+        if len(e) > 10:
+            d.append(f"🔸 ... and {len(e) - 10} more")
+        z.append("\n".join(d))
+    z = "\n\n".join(z) or "🔸 no changes found"
+    replies.add(f"🌐 AUDIT\n🔹 entries:  '{len(y)}'\n🔹 time:  '{t * 1000:.1f}ms'\n\n{z}{x}")
+
+
+# >>> ROUTES
+
+# state -> command -> (handler, guard), a guard hides a command while false
+menu_routes = {
+    "/help": help,
+    "/h": help,
+    "/?": help,
+    "/info": info,
+    "/status": status,
+    "/policy": policy,
+    "/rules": rules,
+    "/optimize": optimize,
+    "/lint": lint,
+    "/test": test,
+    "/hot": hot,
+    "/block": block,
+    "/blocked": blocked,
+    "/autoban": autoban_cmd,
+    "/guide": guide,
+    "/service": service,
+    "/scan": scan,
+    "/watch": watch_cmd,
+    "/snapshot": snapshot,
+    "/audit": audit_cmd,
+}
+screen_routes = {
+    "menu": {},
+    "status_on": {"/stop": status_stop},
+    "status_off": {"/start": status_start},
+    "policy": {"//": policy_set},
+    "rules": {
+        "//": rules_pl,
+        "/del": (rules_del, lambda s: len(ruleset().recs) > 0),
+        "/reset": (rules_rst, lambda s: len(ruleset().recs) > 1),
+        "/move": (rules_mv, lambda s: len(ruleset().recs) > 1),
+    },
+    "optimize": {"/apply": optimize_apply},
+    "hot": {"/apply": hot_apply},
+    "service": {"//": service_pl, "/del": (service_del, lambda s: bool(s.dels))},
+}
+guide_routes = {
+    "guide": {"/s": guide_0},
+    "guide_0": {
+        "/s": guide_1,
+        "/d": (guide_0_def, lambda s: s.gmc[0] != gmd[0]),
+        "//": (guide_0_pl, lambda s: fw()[1].get_rules_count(False) != 0),
+    },
+    "guide_1": {
+        "/s": guide_2,
+        "/b": guide_0,
+        "/out": (guide_1_out, lambda s: s.gmc[1] == gmd[1]),
+        "/d": (guide_1_def, lambda s: s.gmc[1] != gmd[1]),
+    },
+    "guide_2": {
+        "/b": guide_1,
+        "//": guide_2_pl,
+        "/s": (guide_3, lambda s: s.gmc[2] != gmd[2]),
+    },
+    "guide_3": {
+        "/b": guide_2,
+        "/s": guide_4,
+        "//": guide_3_pl,
+        "/d": (guide_3_def, lambda s: s.gmc[3] != gmd[3]),
+    },
+    "guide_4": {
+        "/b": guide_3,
+        "/s": guide_5,
+        "//": guide_4_pl,
+        "/d": (guide_4_def, lambda s: s.gmc[4] != gmd[4]),
+    },
+    "guide_5": {
+        "/b": guide_4,
+        "/s": guide_6,
+        "//": guide_5_pl,
+        "/d": (guide_5_def, lambda s: s.gmc[5] != gmd[5]),
+    },
+    "guide_5_other": {"/b": guide_5, "/src": guide_3, "/dst": guide_4},
+    "guide_6_one": {
+        "/b": guide_5,
+        "//": guide_6_one_pl,
+        "/s": (guide_7, lambda s: s.gmc[6] != gmd[6]),
+    },
+    "guide_6_both": {
+        "/b": guide_5,
+        "//": guide_6_both_pl,
+        "/s": (guide_7, lambda s: not any(c in s.gmc[6] for c in (",", ":"))),
+        "/d": (guide_6_both_def, lambda s: s.gmc[6] != gmd[6]),
+    },
+    "guide_6_other": {
+        "/b": guide_5,
+        "/s": (guide_7, lambda s: s.gmc[6] == gmd[6]),
+        "/d": (guide_6_other_def, lambda s: s.gmc[6] != gmd[6]),
+    },
+    "guide_7": {
+        "/b": guide_6,
+        "/s": guide_finish,
+        "//": guide_7_pl,
+        "/d": (guide_7_def, lambda s: s.gmc[7] != gmd[7]),
+    },
+    "guide_finish": {"/b": guide_6, "/f": guide_exec},
+}
+
+
+def route_table():
+    x = {}
+    for k, v in screen_routes.items():
+        x[k] = {**menu_routes, **v}
+    for k, v in guide_routes.items():
+        x[k] = {**{c: fake for c in menu_routes}, "/q": guide_q, **v}
+    for k, v in x.items():
+        x[k] = {c: d if isinstance(d, tuple) else (d, None) for c, d in v.items()}
+    return x
+
+
+routes = route_table()
+
+# queued for the mutation worker or served from the read pool, all other
+# handlers only render a screen and stay in the hook
+writes = {
+    status_start,
+    status_stop,
+    policy_set,
+    rules_pl,
+    rules_del,
+    rules_rst,
+    rules_mv,
+    service_pl,
+    service_del,
+    guide_exec,
+    optimize_apply,
+    hot_apply,
+    block,
+    snapshot,
+}
+reads = {info, status, policy, rules, optimize, lint, test, hot, blocked, service, scan, audit_cmd}
+# screen a read ends on, the handler leaves it for the menu if it fails
+screens = {
+    status: lambda: "status_on" if fw()[1].is_enabled() else "status_off",
+    policy: "policy",
+    rules: "rules",
+    optimize: "optimize",
+    hot: "hot",
+    service: "service",
+}
+
+
 # >>> TESTCODE / NOTES
 
 # NOPE: support for named protocols -> rules will use the actual ports, user might not recognize
@@ -1190,7 +4657,6 @@ def scan(command, replies):
 # NOPE: f-string alignment -> no monospaced font in chats
 # NOPE: find better ufw man and set link -> no better manpage available
 
-# TODO: scan
 # TODO: add ufw and python version to /info, add nmap info (installed, version)
 # TODO: code optimization for service_set(), service() and others
 # TODO: comments / docstrings
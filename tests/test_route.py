@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+
+import firewall_bot as fb
+
+commands = pytest.importorskip("deltabot.commands")
+if getattr(commands, "__file__", None) is None:
+    pytest.skip("deltabot is not installed", allow_module_level=True)
+
+
+class Chat:
+    id = 7
+
+    def is_group(self):
+        return True
+
+    def is_protected(self):
+        return True
+
+    def get_name(self):
+        return "admins"
+
+
+class Message:
+    id = 1
+
+    def __init__(self, text):
+        self.text = text
+        self.chat = Chat()
+
+    def get_sender_contact(self):
+        return SimpleNamespace(addr="admin@example.org")
+
+
+class Replies(list):
+    def add(self, text=None, **kw):
+        self.append(text)
+
+
+# deltabot's own command dispatch with every command routed like deltabot_init does
+@pytest.fixture
+def bot(monkeypatch):
+    x = SimpleNamespace(logger=mock.Mock(), plugins=mock.Mock())
+    x.get = {"admgrpid": "7"}.get
+    x.commands = commands.Commands(x)
+    for c in sorted(set().union(*fb.routes.values())):
+        x.commands.register(name=c, func=fb.route)
+    monkeypatch.setattr(fb, "dbot", x, raising=False)
+    monkeypatch.setattr(fb, "sessions", fb.OrderedDict())
+    yield x
+    x.logger.exception.assert_not_called()
+
+
+def send(bot, text):
+    x = Replies()
+    assert bot.commands.deltabot_incoming_message(Message(text), x)
+    return x
+
+
+def test_help(bot):
+    x = send(bot, "/help")
+    assert len(x) == 1 and x[0].startswith("🌐 MENU")
+
+
+def test_not_available(bot):
+    assert send(bot, "/del 1") == ["⚠️ command not available"]
+
+
+def test_screen_ahead(bot, monkeypatch):
+    monkeypatch.setattr(fb, "pool", mock.Mock())
+    monkeypatch.setattr(fb, "wq", fb.queue.Queue())
+    assert send(bot, "/rules") == []
+    fb.pool.submit.assert_called_once()
+    # the read hasn't run yet, its screen is open already
+    assert send(bot, "// allow 22") == ["⏳ queued (0 ahead)"]
+    assert fb.wq.qsize() == 1
+
+
+def test_hook_not_blocked(bot):
+    send(bot, "/help")
+    ses = next(iter(fb.sessions.values()))
+    held = fb.threading.Event()
+    done = fb.threading.Event()
+
+    # like a long write of the same admin on the worker
+    def hold():
+        with ses.lock:
+            held.set()
+            done.wait(2)
+
+    t = fb.threading.Thread(target=hold)
+    t.start()
+    held.wait(2)
+    x = send(bot, "/guide")
+    assert t.is_alive()
+    done.set()
+    t.join()
+    assert len(x) == 1 and x[0].startswith("🌐")
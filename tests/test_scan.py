@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import socket
+import threading
+
+import pytest
+
+import firewall_bot as fb
+
+
+def scan(port, proto):
+    return asyncio.run(fb.scan_run(socket.AF_INET, "127.0.0.1", [(port, port)], proto, 16, 0))
+
+
+def free(kind):
+    with socket.socket(socket.AF_INET, kind) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def tcp():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    s.listen()
+    yield s.getsockname()[1]
+    s.close()
+
+
+# answers every datagram, like a service that speaks first
+@pytest.fixture
+def udp():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(("127.0.0.1", 0))
+    s.settimeout(0.1)
+    stop = threading.Event()
+
+    def run():
+        while not stop.is_set():
+            try:
+                _, a = s.recvfrom(512)
+                s.sendto(b"x", a)
+            except OSError:
+                pass
+
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+    yield s.getsockname()[1]
+    stop.set()
+    t.join()
+    s.close()
+
+
+def test_tcp_listener(tcp):
+    assert scan(tcp, "tcp") == {tcp: "open"}
+    assert tcp in fb.scan_listening("127.0.0.1", "tcp")
+
+
+def test_tcp_closed():
+    port = free(socket.SOCK_STREAM)
+    assert scan(port, "tcp") == {port: "closed"}
+    assert port not in fb.scan_listening("127.0.0.1", "tcp")
+
+
+def test_udp_listener(udp):
+    assert scan(udp, "udp") == {udp: "open"}
+    assert udp in fb.scan_listening("127.0.0.1", "udp")
+
+
+def test_udp_closed():
+    port = free(socket.SOCK_DGRAM)
+    assert scan(port, "udp") == {port: "closed"}
+
+
+def test_range(tcp):
+    x = asyncio.run(
+        fb.scan_run(socket.AF_INET, "127.0.0.1", fb.port_ranges(f"{tcp - 20}:{tcp}"), "tcp", 4, 0)
+    )
+    assert len(x) == 21
+    assert x[tcp] == "open"